@@ -0,0 +1,159 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Set, Tuple
+
+
+# 認可の判定に使う最低限のユーザー情報。Userの行をそのまま持たずに済むように小さくしている
+class UserSnapshot:
+    __slots__ = ("id", "room_id", "role_key", "state")
+
+    def __init__(self, id: int, room_id: int | None, role_key: str | None, state: str):
+        self.id = id
+        self.room_id = room_id
+        self.role_key = role_key
+        self.state = state
+
+
+# session_token → UserSnapshot のLRUキャッシュ。
+# 入退室やゲームの開始・終了で部屋の参加者の情報が変わるので、部屋単位でも無効化できるようにしている。
+# 部屋に入っていないユーザーは部屋単位では無効化できないので、他のワーカーで入室したときのためにユーザー単位でも引けるようにしている
+class UserCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 30.0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, UserSnapshot]] = OrderedDict()
+        self._rooms: Dict[int, Set[str]] = {}
+        self._users: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_token: str) -> UserSnapshot | None:
+        with self._lock:
+            entry = self._entries.get(session_token)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                self._discard(session_token)
+                return None
+            self._entries.move_to_end(session_token)
+            return user
+
+    def put(self, session_token: str, user: UserSnapshot):
+        with self._lock:
+            self._discard(session_token)
+            self._entries[session_token] = (time.monotonic() + self._ttl, user)
+            self._users[user.id] = session_token
+            if user.room_id is not None:
+                self._rooms.setdefault(user.room_id, set()).add(session_token)
+            while len(self._entries) > self._maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, session_token: str):
+        with self._lock:
+            self._discard(session_token)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            session_token = self._users.get(user_id)
+            if session_token is not None:
+                self._discard(session_token)
+
+    def invalidate_room(self, room_id: int):
+        with self._lock:
+            for session_token in list(self._rooms.get(room_id, ())):
+                self._discard(session_token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rooms.clear()
+            self._users.clear()
+
+    def _discard(self, session_token: str):
+        entry = self._entries.pop(session_token, None)
+        if entry is None:
+            return
+        if self._users.get(entry[1].id) == session_token:
+            del self._users[entry[1].id]
+        room_id = entry[1].room_id
+        if room_id is None:
+            return
+        tokens = self._rooms.get(room_id)
+        if tokens is not None:
+            tokens.discard(session_token)
+            if not tokens:
+                del self._rooms[room_id]
+
+
+user_cache = UserCache()
+
+
+# GET /rooms/ と GET /users/ のレスポンスの本文とETagを持つ。ETagは本文のハッシュなので、同じ一覧を返すワーカーは
+# どれも同じETagを付け、他のワーカーが返したETagでも304を返せる。
+# 一覧の版は部屋の一覧(ロビー)と部屋ごとの参加者の一覧について持ち、手元の変更とイベントバスで届いた変更で進める。
+# 本文は読む前の版と一緒に置き、版が進んでいたら読み直す。
+# room_idがNoneの版は部屋に入っていないユーザーの一覧。RoomPublicは参加者を含むので、部屋の版を進めるとロビーの版も進む
+class ListingCache:
+    def __init__(self, maxsize: int = 1024):
+        self._maxsize = maxsize
+        self._lobby = 0
+        self._rooms: Dict[int | None, int] = {}
+        self._entries: OrderedDict[Tuple, Tuple[int, str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump_lobby(self):
+        with self._lock:
+            self._lobby += 1
+
+    def bump_room(self, room_id: int | None):
+        with self._lock:
+            self._rooms[room_id] = self._rooms.get(room_id, 0) + 1
+            self._lobby += 1
+
+    def lobby_version(self) -> int:
+        with self._lock:
+            return self._lobby
+
+    def room_version(self, room_id: int | None) -> int:
+        with self._lock:
+            return self._rooms.get(room_id, 0)
+
+    # keyは一覧の種類とレスポンスの内容を変えるクエリパラメータ。versionの本文が無ければNone
+    def get(self, key: Tuple, version: int) -> Tuple[str, bytes] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key: Tuple, version: int, body: bytes) -> Tuple[str, bytes]:
+        etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+        with self._lock:
+            self._entries[key] = (version, etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        return etag, body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Matchは弱い比較で判定する
+    tag = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == tag
+        for candidate in if_none_match.split(",")
+    )
+
+
+listing_cache = ListingCache()
@@ -0,0 +1,384 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from uuid import uuid4
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from cache import listing_cache, user_cache
+from message_log import message_log
+from realtime import message_hub, message_notifier, room_event_broker
+from room_state import room_states
+from voting import vote_tally
+from victory import alive_counter
+from models import Message, MessagePublic, Room, RoomStateEnum, RoomStateEvent
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Mapping, Set
+
+logger = logging.getLogger(__name__)
+
+# ワーカー間でチャットと部屋の状態遷移を配る。環境変数で切り替える。
+#   EVENT_BUS       local(既定、このプロセスの中だけで配る) / postgres(LISTEN/NOTIFYで他のワーカーにも配る)
+#   EVENT_BUS_URL   postgresのときの接続先(未設定ならDATABASE_URLと同じDB)
+
+# イベントの種類。messageのkeyはtarget_groupでpayloadはMessagePublic / MessageWolfのJSON、
+# stateのkeyはstateでpayloadはRoomStateEventのJSON。roomは部屋の設定や参加者が変わったことだけを伝え、refは入退室したUser.id。
+# voteのkeyは投票の種類でpayloadは[期限, 投票者, 投票先]のJSON、refはVote.id。
+# aliveのpayloadは陣営ごとの生存者数のJSONで、ゲームが終わった部屋はnull
+EVENTMESSAGE = "message"
+EVENTSTATE = "state"
+EVENTROOM = "room"
+EVENTVOTE = "vote"
+EVENTALIVE = "alive"
+
+
+# payloadは発行したときに一度だけシリアライズしたJSON。配送先ではそのまま流す。
+# refはpayloadの元になった行のid(messageならMessage.id)で、payloadを落として送ったときに配送先が読み直すのに使う
+class Event:
+    __slots__ = ("kind", "room_id", "key", "payload", "ref")
+
+    def __init__(
+        self,
+        kind: str,
+        room_id: int,
+        key: str | None,
+        payload: str | None,
+        ref: int | None = None,
+    ):
+        self.kind = kind
+        self.room_id = room_id
+        self.key = key
+        self.payload = payload
+        self.ref = ref
+
+
+# remoteは他のワーカーが発行したイベントかどうか
+Handler = Callable[[Event, bool], None]
+
+
+# このプロセスの中だけで配るバス。発行したその場で購読者に渡す
+class LocalEventBus:
+    remote = False
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    def subscribe(self, kind: str, handler: Handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def publish(
+        self,
+        kind: str,
+        room_id: int,
+        key: str | None,
+        payload: str | None,
+        ref: int | None = None,
+    ):
+        self._dispatch(Event(kind, room_id, key, payload, ref), False)
+
+    def _dispatch(self, event: Event, remote: bool):
+        for handler in self._handlers.get(event.kind, ()):
+            try:
+                handler(event, remote)
+            except Exception:
+                logger.exception("Failed to deliver %s event.", event.kind)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+EVENTCHANNEL = "zinro_events"
+MAXNOTIFYBYTES = 7900  # NOTIFYのペイロードは8000バイト未満
+
+
+# PostgreSQLのLISTEN/NOTIFYで他のワーカーにも配るバス。手元の購読者にはその場で渡し、
+# 他のワーカー向けにはinterval秒の間に発行されたイベントをまとめて1回のNOTIFYで送る。
+# 自分の送ったNOTIFYも届くので、originで見分けて読み飛ばす
+class PostgresEventBus(LocalEventBus):
+    remote = True
+
+    def __init__(self, dsn: str, interval: float = 0.005):
+        super().__init__()
+        self._dsn = dsn
+        self._interval = interval
+        self._origin = uuid4().hex
+        self._pending: List[Event] = []
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._connection = None
+        self._flushing = False
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self._connect()
+
+    async def stop(self):
+        await self._flush()
+        self._loop = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _connect(self):
+        import asyncpg
+
+        self._connection = await asyncpg.connect(self._dsn)
+        await self._connection.add_listener(EVENTCHANNEL, self._on_notify)
+
+    def publish(
+        self,
+        kind: str,
+        room_id: int,
+        key: str | None,
+        payload: str | None,
+        ref: int | None = None,
+    ):
+        event = Event(kind, room_id, key, payload, ref)
+        self._dispatch(event, False)
+        # 送信はstartしたループで行う。TestClientのリクエストは別のスレッドのループから発行する
+        with self._lock:
+            self._pending.append(event)
+            if self._flushing or self._loop is None:
+                return
+            self._flushing = True
+        self._loop.call_soon_threadsafe(self._flush_later)
+
+    def _flush_later(self):
+        task = asyncio.get_running_loop().create_task(self._sleep_and_flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _sleep_and_flush(self):
+        await asyncio.sleep(self._interval)
+        await self._flush()
+
+    async def _flush(self):
+        with self._lock:
+            events, self._pending = self._pending, []
+            self._flushing = False
+        if not events:
+            return
+        try:
+            if self._connection is None or self._connection.is_closed():
+                await self._connect()
+            for batch in self.encode(events):
+                await self._connection.execute(
+                    "SELECT pg_notify($1, $2)", EVENTCHANNEL, batch
+                )
+        except Exception:
+            logger.exception("Failed to publish %d events.", len(events))
+
+    # NOTIFYの上限に収まるように分けて、1つのバッチを1つのJSONにする。
+    # 1件だけで上限を超えるイベントはpayloadを落としてrefだけを送り、受け取った側はrefの行をDBから読み直す
+    def encode(self, events: List[Event]) -> List[str]:
+        prefix = json.dumps({"origin": self._origin})[:-1] + ', "events": ['
+        batches = []
+        entries: List[str] = []
+        size = len(prefix) + 2
+        for event in events:
+            entry = json.dumps(
+                [event.kind, event.room_id, event.key, event.payload, event.ref]
+            )
+            if len(prefix) + len(entry.encode()) + 2 > MAXNOTIFYBYTES:
+                entry = json.dumps(
+                    [event.kind, event.room_id, event.key, None, event.ref]
+                )
+            length = len(entry.encode()) + 1
+            if entries and size + length > MAXNOTIFYBYTES:
+                batches.append(prefix + ",".join(entries) + "]}")
+                entries, size = [], len(prefix) + 2
+            entries.append(entry)
+            size += length
+        if entries:
+            batches.append(prefix + ",".join(entries) + "]}")
+        return batches
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str):
+        batch = json.loads(payload)
+        if batch["origin"] == self._origin:
+            return
+        for kind, room_id, key, event_payload, ref in batch["events"]:
+            self._dispatch(Event(kind, room_id, key, event_payload, ref), True)
+
+
+def create_event_bus(environ: Mapping[str, str] = os.environ) -> LocalEventBus:
+    backend = environ.get("EVENT_BUS", "local").strip().lower()
+    if backend == "local":
+        return LocalEventBus()
+    if backend == "postgres":
+        url = environ.get("EVENT_BUS_URL")
+        if not url:
+            from database import get_database_url
+
+            url = get_database_url(environ)
+        # asyncpgに直接渡すので、SQLAlchemyのドライバ名を外す
+        dsn = make_url(url).set(drivername="postgresql")
+        return PostgresEventBus(dsn.render_as_string(hide_password=False))
+    raise ValueError(f"Unknown EVENT_BUS: {backend}")
+
+
+event_bus = create_event_bus()
+
+
+# 他のワーカーで書き込まれたメッセージは手元のmessage_logに無いが、他のワーカーがいるときの新着の取得はDBから読むので、
+# 部屋の情報のキャッシュは捨てない。
+# payloadを落として届いたメッセージは、このワーカーで1回だけDBから読み直してシリアライズし、接続に配る
+def _deliver_message(event: Event, remote: bool):
+    message_notifier.notify(event.room_id)
+    if event.payload is not None:
+        message_hub.publish(event.room_id, event.key, event.payload)
+    elif event.ref is not None and message_hub.connections(event.room_id):
+        task = asyncio.get_running_loop().create_task(
+            _publish_fetched(event.room_id, event.key, event.ref)
+        )
+        _fetching.add(task)
+        task.add_done_callback(_fetching.discard)
+
+
+_fetching: Set[asyncio.Task] = set()
+FETCHRETRIES = 5
+FETCHINTERVAL = 0.1  # 秒
+
+
+# 読み取り用のレプリカは遅れることがあるので、書き込み用のDBから読む。
+# NOTIFYは書き込みのコミット後に送るので普通は1回で読めるが、読めなければ少し待って読み直す
+async def _publish_fetched(room_id: int, target_group: str | None, message_id: int):
+    from database import engine
+
+    for _ in range(FETCHRETRIES):
+        try:
+            async with AsyncSession(engine) as session:
+                message = (
+                    await session.exec(
+                        select(Message)
+                        .where(Message.id == message_id)
+                        .options(
+                            selectinload(Message.user),
+                            selectinload(Message.room).selectinload(Room.users),
+                        )
+                    )
+                ).first()
+                payload = (
+                    None
+                    if message is None
+                    else MessagePublic.model_validate(message).model_dump_json()
+                )
+        except Exception:
+            logger.exception("Failed to fetch message %d.", message_id)
+            payload = None
+        if payload is not None:
+            message_hub.publish(room_id, target_group, payload)
+            return
+        await asyncio.sleep(FETCHINTERVAL)
+    logger.warning("Dropped message %d that could not be fetched.", message_id)
+
+
+# 他のワーカーで変わった部屋は、手元の部屋の状態と参加者の情報を読み直させる
+def _invalidate_room(room_id: int | None):
+    listing_cache.bump_room(room_id)
+    if room_id is None:
+        return
+    room_states.discard(room_id)
+    message_log.invalidate_room(room_id)
+    user_cache.invalidate_room(room_id)
+
+
+def _deliver_state(event: Event, remote: bool):
+    if remote:
+        _invalidate_room(event.room_id)
+        if event.key == str(RoomStateEnum.CLOSED.value):
+            vote_tally.discard(event.room_id)
+            alive_counter.discard(event.room_id)
+    else:
+        listing_cache.bump_room(event.room_id)
+    if event.payload is not None:
+        room_event_broker.publish(event.room_id, event.key, event.payload)
+
+
+def _deliver_room(event: Event, remote: bool):
+    if remote:
+        _invalidate_room(event.room_id)
+        if event.ref is not None:
+            user_cache.invalidate_user(event.ref)
+    else:
+        listing_cache.bump_room(event.room_id)
+
+
+# 他のワーカーで受けた票を手元の得票数に足す。手元で受けた票はcast_voteで足してある
+def _deliver_vote(event: Event, remote: bool):
+    if not remote:
+        return
+    deadline, user_id, target_id = json.loads(event.payload)
+    vote_tally.cast(
+        event.room_id,
+        event.key,
+        datetime.fromisoformat(deadline),
+        user_id,
+        target_id,
+        event.ref,
+    )
+
+
+# 他のワーカーでゲームを始めた・死亡を反映した部屋の生存者数で、手元の値を置き換える
+def _deliver_alive(event: Event, remote: bool):
+    if remote:
+        alive_counter.put(event.room_id, json.loads(event.payload))
+
+
+event_bus.subscribe(EVENTMESSAGE, _deliver_message)
+event_bus.subscribe(EVENTSTATE, _deliver_state)
+event_bus.subscribe(EVENTROOM, _deliver_room)
+event_bus.subscribe(EVENTVOTE, _deliver_vote)
+event_bus.subscribe(EVENTALIVE, _deliver_alive)
+
+
+def publish_message(
+    room_id: int, target_group: str | None, payload: str, message_id: int
+):
+    event_bus.publish(EVENTMESSAGE, room_id, target_group, payload, message_id)
+
+
+def publish_state(room_id: int, state: str, next_state_update_at: datetime):
+    # 他のワーカーに配らないなら、SSEの購読者がいない部屋はシリアライズもしない
+    payload = None
+    if event_bus.remote or room_event_broker.subscribers(room_id):
+        payload = RoomStateEvent(
+            id=room_id, state=state, next_state_update_at=next_state_update_at
+        ).model_dump_json()
+    event_bus.publish(EVENTSTATE, room_id, state, payload)
+
+
+# room_idがNoneなら、部屋に入っていないユーザーの一覧が変わったことを伝える。
+# 入退室したユーザーはuser_idで渡し、他のワーカーにそのユーザーの情報を読み直させる
+def publish_room(room_id: int | None, user_id: int | None = None):
+    event_bus.publish(EVENTROOM, room_id, None, None, user_id)
+
+
+# 得票数・生存者数は手元ではその場で更新しているので、他のワーカーに配らないなら何もしない
+def publish_vote(
+    room_id: int,
+    kind: str,
+    deadline: datetime,
+    user_id: int,
+    target_id: int,
+    vote_id: int,
+):
+    if not event_bus.remote:
+        return
+    payload = json.dumps([deadline.isoformat(), user_id, target_id])
+    event_bus.publish(EVENTVOTE, room_id, kind, payload, vote_id)
+
+
+def publish_alive(room_ids: Iterable[int]):
+    if not event_bus.remote:
+        return
+    for room_id in room_ids:
+        payload = json.dumps(alive_counter.snapshot(room_id))
+        event_bus.publish(EVENTALIVE, room_id, None, payload)
@@ -10,13 +10,38 @@ from fastapi import (
     FastAPI,
     Query,
     Cookie,
+    Header,
     Response,
     HTTPException,
     status,
     Request,
+    WebSocket,
 )
-from sqlmodel import Field, Relationship, Session, SQLModel, create_engine, select
-from database import engine
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import TypeAdapter
+from sqlmodel import Field, Relationship, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import case, update
+from sqlalchemy.orm import selectinload
+from database import engine, read_engine
+from phase_engine import phase_engine
+from scheduler import claim_rooms
+from cache import UserSnapshot, etag_matches, listing_cache, user_cache
+from roles import assign_roles, can, message_group, visible_groups
+from realtime import message_hub, message_notifier, room_event_broker
+from event_bus import (
+    event_bus,
+    publish_alive,
+    publish_message,
+    publish_room,
+    publish_state,
+    publish_vote,
+)
+from message_log import message_log, message_writer
+from metrics import metrics
+from voting import VOTEKINDACTION, apply_votes, finish_votes, vote_tally
+from victory import alive_counter, end_games, finish_games
+from room_state import RoomState, room_states
 from models import (
     User,
     UserPublicWithName,
@@ -28,52 +53,91 @@ from models import (
     Room,
     RoomUpdate,
     RoomStateEnum,
+    RoomStateEvent,
     ROOMSTATECYCLE,
     ROOMSTATETIME,
+    ROOMINGAMESTATES,
+    ActionFlag,
+    RoleGroupWolf,
     Message,
     MessageCreate,
     MessagePublic,
+    MessageCompact,
+    MessagePage,
     MessageWolf,
+    Vote,
+    VoteCreate,
+    VoteKindEnum,
+    VotePublic,
     ROLETOGROUP,
 )
 from datetime import datetime, timedelta
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from starlette.middleware.base import BaseHTTPMiddleware
-from typing import List
-
-
-# 時間経過による更新処理をここで行う
-def update_by_time(session: Session):
-    rooms: List[Room] = session.exec(select(Room)).all()
-    for room in rooms:
-        if room.next_state_update_at <= datetime.now() and room.state != str(
-            RoomStateEnum.CLOSED.value
-        ):
-            room.state = str(ROOMSTATECYCLE[room.state])
-            room.next_state_update_at += timedelta(minutes=ROOMSTATETIME[room.state])
-            session.add(room)
-    session.commit()
-    return session
-
-
-def get_session():
-    with Session(engine) as session:
-        update_by_time(session=session)
+from typing import List, Tuple, Type
+
+
+async def get_session():
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+
+
+# GETのエンドポイント用。DATABASE_READ_URLが設定されていれば読み取り専用レプリカにつなぐ
+async def get_read_session():
+    async with AsyncSession(read_engine, expire_on_commit=False) as session:
         yield session
 
 
-app = FastAPI()
+# 時間経過による更新処理はphase_engineがバックグラウンドで行うので、読み取り系のエンドポイントは書き込まない
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await event_bus.start()
+    await phase_engine.start()
+    yield
+    await phase_engine.stop()
+    await event_bus.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# ルートごとの所要時間・SQLの数・SQLの実行時間をmetricsに記録する。
+# ストリーミングのレスポンスはヘッダーを返すまでを測る
+class MetricsMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        with metrics.track() as stats:
+            try:
+                response = await call_next(request)
+                status_code = response.status_code
+            finally:
+                route = request.scope.get("route")
+                metrics.observe_request(
+                    request.method,
+                    getattr(route, "path", "unmatched"),
+                    status_code,
+                    stats,
+                )
+        return response
+
 
+app.add_middleware(MetricsMiddleware)
 
-def get_user(
+
+async def get_user(
     session_token: str,
-    session: Session,
+    session: AsyncSession,
 ):
     if session_token is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"You have not created a user yet.",
         )
-    user = session.exec(select(User).where(User.session_token == session_token)).one()
+    user = (
+        await session.exec(select(User).where(User.session_token == session_token))
+    ).one()
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -82,21 +146,101 @@ def get_user(
     return user
 
 
+# 認可の判定だけで済むエンドポイント用。user_cacheに当たればDBに問い合わせない
+async def get_user_snapshot(
+    session_token: str,
+    session: AsyncSession,
+) -> UserSnapshot:
+    if session_token is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"You have not created a user yet.",
+        )
+    user = user_cache.get(session_token)
+    if user is not None:
+        return user
+    row = (
+        await session.exec(
+            select(User.id, User.room_id, User.role_key, User.state).where(
+                User.session_token == session_token
+            )
+        )
+    ).first()
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Your session_token is invalid.",
+        )
+    user = UserSnapshot(*row)
+    user_cache.put(session_token, user)
+    return user
+
+
+# 一覧のレスポンス。If-None-MatchがETagと一致すれば本文を送らずに304を返す
+def listing_response(if_none_match: str | None, etag: str, body: bytes) -> Response:
+    if etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+ROOMLIST = TypeAdapter(List[RoomPublic])
+USERLIST = TypeAdapter(List[UserPublicWithoutName])
+
+
+async def get_room_with_users(session: AsyncSession, room_id: int) -> Room:
+    rooms = await session.exec(
+        select(Room)
+        .where(Room.id == room_id)
+        .options(selectinload(Room.users))
+        .execution_options(populate_existing=True)
+    )
+    return rooms.one()
+
+
+# ルールの判定に使う部屋の状態。room_statesに当たればDBに問い合わせない
+async def get_room_state(session: AsyncSession, room_id: int) -> RoomState:
+    room = await room_states.get(session, room_id)
+    if room is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"This room does not exist.",
+        )
+    return room
+
+
+async def get_message_with_relations(session: AsyncSession, message_id: int) -> Message:
+    messages = await session.exec(
+        select(Message)
+        .where(Message.id == message_id)
+        .options(
+            selectinload(Message.user),
+            selectinload(Message.room).selectinload(Room.users),
+        )
+    )
+    return messages.one()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/time/")
-def read_time(*, session: Session = Depends(get_session)):
-    update_by_time(session=session)
+async def read_time(*, session: AsyncSession = Depends(get_read_session)):
     return {"time": str(datetime.now())}
 
 
 @app.get("/me/", response_model=UserPublicWithName)
-def read_users(
+async def read_users(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
     session_token: str = Cookie(None),
 ):
-    update_by_time(session=session)
-
-    user = get_user(session_token, session)
+    user = await get_user(session_token, session)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -106,14 +250,13 @@ def read_users(
 
 
 @app.post("/users/", response_model=UserPublicWithName)
-def create_user(
+async def create_user(
     *,
     response: Response,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     user: UserCreate,
     session_token: str | None = Cookie(None),
 ):
-    update_by_time(session=session)
     if session_token is not None:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
@@ -124,36 +267,50 @@ def create_user(
     response.set_cookie(key="session_token", value=db_user.session_token)
 
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    await session.commit()
+    await session.refresh(db_user)
+    publish_room(None)
     return db_user
 
 
+# 一覧はlisting_cacheに置いた本文から返し、版が進んだときだけDBを読む。
+# レプリカの遅れで古い一覧に新しいETagが付かないように、書き込み用のDBから読む
 @app.get("/users/", response_model=list[UserPublicWithoutName])
-def read_users(
+async def read_users(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     offset: int = 0,
     limit: int = Query(default=100, le=100),
     session_token: str = Cookie(None),
+    if_none_match: str | None = Header(None),
 ):
-    update_by_time(session=session)
-    user = get_user(session_token, session)
-    users = session.exec(
-        select(User).where(User.room_id == user.room_id).offset(offset).limit(limit)
-    ).all()
-    return users
+    user = await get_user_snapshot(session_token, session)
+    key = ("users", user.room_id, offset, limit)
+    # 版は読む前に控えておき、読んでいる間に変わったら次のリクエストで読み直す
+    version = listing_cache.room_version(user.room_id)
+    cached = listing_cache.get(key, version)
+    if cached is None:
+        users = (
+            await session.exec(
+                select(User)
+                .where(User.room_id == user.room_id)
+                .offset(offset)
+                .limit(limit)
+            )
+        ).all()
+        body = USERLIST.dump_json(USERLIST.validate_python(users, from_attributes=True))
+        cached = listing_cache.put(key, version, body)
+    return listing_response(if_none_match, *cached)
 
 
 @app.get("/users/{user_id}/", response_model=UserPublicWithName)
-def read_my_information(
+async def read_my_information(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
     session_token: str = Cookie(None),
     user_id: int,
 ):
-    update_by_time(session=session)
-    user = get_user(session_token, session)
+    user = await get_user(session_token, session)
     if user_id != user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -163,37 +320,54 @@ def read_my_information(
 
 
 @app.post("/rooms/", response_model=RoomPublic)
-def create_room(*, session: Session = Depends(get_session), room: RoomCreate):
-    update_by_time(session=session)
+async def create_room(
+    *, session: AsyncSession = Depends(get_session), room: RoomCreate
+):
     db_room = Room.model_validate(room)
     session.add(db_room)
-    session.commit()
-    session.refresh(db_room)
+    await session.commit()
+    db_room = await get_room_with_users(session, db_room.id)
+    room_states.create(db_room.id, db_room.state, db_room.next_state_update_at)
+    publish_room(db_room.id)
+    phase_engine.schedule(db_room.id, db_room.next_state_update_at)
     return db_room
 
 
 @app.get("/rooms/", response_model=list[RoomPublic])
-def read_rooms(
+async def read_rooms(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     offset: int = 0,
     limit: int = Query(default=100, le=100),
+    if_none_match: str | None = Header(None),
 ):
-    update_by_time(session=session)
-    rooms = session.exec(select(Room).offset(offset).limit(limit)).all()
-    return rooms
+    key = ("rooms", offset, limit)
+    version = listing_cache.lobby_version()
+    cached = listing_cache.get(key, version)
+    if cached is None:
+        # RoomPublic.usersのために部屋ごとに遅延読み込みしないよう、参加者をまとめて読む
+        rooms = (
+            await session.exec(
+                select(Room)
+                .options(selectinload(Room.users))
+                .offset(offset)
+                .limit(limit)
+            )
+        ).all()
+        body = ROOMLIST.dump_json(ROOMLIST.validate_python(rooms, from_attributes=True))
+        cached = listing_cache.put(key, version, body)
+    return listing_response(if_none_match, *cached)
 
 
 @app.patch("/rooms/{room_id}/settings/", response_model=RoomPublic)
-def update_rooms(
+async def update_rooms(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
     room_id: int,
     room: RoomUpdate,
 ):
-    update_by_time(session=session)
-    user = get_user(session_token, session)
+    user = await get_user_snapshot(session_token, session)
     if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -204,39 +378,40 @@ def update_rooms(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"You can not update the room setting that you are not in.",
         )
-    db_room = session.exec(select(Room).where(Room.id == room_id)).one()
+    db_room = await get_room_with_users(session, room_id)
     room_data = room.model_dump(exclude_unset=True)
 
     for key, value in room_data.items():
         setattr(db_room, key, value)
 
     session.add(db_room)
-    session.commit()
-    session.refresh(db_room)
+    await session.commit()
+    message_log.invalidate_room(room_id)
+    publish_room(room_id)
+    db_room = await get_room_with_users(session, room_id)
     print(db_room)
     return db_room
 
 
 @app.post("/rooms/entrance/", response_model=RoomPublic)
-def enter_room(
+async def enter_room(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
     room_id: int,
     isWatcher: bool = False,
 ):
-    update_by_time(session=session)
-    db_user = get_user(session_token, session)
-    if db_user.room is not None:
+    db_user = await get_user(session_token, session)
+    if db_user.room_id is not None:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail=f"You have entered a room.",
         )
+    room = await get_room_state(session, room_id)
     db_user.room_id = room_id
     if isWatcher:
         db_user.state = str(UserStateEnum.WATCHER.value)
     else:
-        room = session.exec(select(Room).where(Room.id == db_user.room_id)).one()
         if room.state == str(RoomStateEnum.CLOSED.value):
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -252,41 +427,49 @@ def enter_room(
                 detail=f"The game has started. You can only enter the room as a watcher.",
             )
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
-    return db_user.room
+    await session.commit()
+    user_cache.invalidate(session_token)
+    message_log.invalidate_room(room_id)
+    room_states.enter(room_id, db_user.id, isWatcher)
+    publish_room(room_id, db_user.id)
+    publish_room(None)
+    return await get_room_with_users(session, room_id)
 
 
 @app.post("/rooms/exit/", response_model=UserPublicWithName)
-def exit_room(
+async def exit_room(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
 ):
-    update_by_time(session=session)
-    db_user = get_user(session_token, session)
-    if db_user.room is None:
+    db_user = await get_user(session_token, session)
+    if db_user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"You have not entered a room.",
         )
+    room_id = db_user.room_id
     db_user.room_id = None
     db_user.state = str(UserStateEnum.OUTSIDE.value)
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    await session.commit()
+    await session.refresh(db_user)
+    user_cache.invalidate(session_token)
+    message_log.invalidate_room(room_id)
+    room_states.exit(room_id, db_user.id)
+    publish_room(room_id, db_user.id)
+    publish_room(None)
     return db_user
 
 
 @app.post("/rooms/{room_id}/close/")
-def close_room(
+async def close_room(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
     room_id: int,
 ):
-    update_by_time(session=session)
-    user = get_user(session_token=session_token, session=session)
+    user = await get_user_snapshot(session_token=session_token, session=session)
     if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -297,26 +480,34 @@ def close_room(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"You can not update the room setting that you are not in.",
         )
-    db_room = session.exec(select(Room).where(Room.id == room_id)).one()
+    db_room = await session.get(Room, room_id)
     db_room.state = str(RoomStateEnum.CLOSED.value)
-    for db_user in db_room.users:
-        db_user.room_id = None
-        db_user.state = str(UserStateEnum.OUTSIDE.value)
-        session.add(db_user)
     session.add(db_room)
-    session.commit
+    # 参加者全員を1文で部屋から出す
+    await session.exec(
+        update(User)
+        .where(User.room_id == room_id)
+        .values(room_id=None, state=str(UserStateEnum.OUTSIDE.value))
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    user_cache.invalidate_room(room_id)
+    vote_tally.discard(room_id)
+    message_log.discard(room_id)
+    room_states.discard(room_id)
+    publish_room(None)
+    publish_state(db_room.id, db_room.state, db_room.next_state_update_at)
     return {"state": "ok"}
 
 
 @app.post("/rooms/{room_id}/game/start/", response_model=RoomPublic)
-def game_start(
+async def game_start(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
     room_id: int,
 ):
-    update_by_time(session=session)
-    user = get_user(session_token=session_token, session=session)
+    user = await get_user_snapshot(session_token=session_token, session=session)
     if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -327,61 +518,101 @@ def game_start(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"You can not update the room setting that you are not in.",
         )
-    db_room = session.exec(select(Room).where(Room.id == room_id)).one()
-    if db_room.state != str(RoomStateEnum.BEFOREGAME.value):
+    room = await get_room_state(session, room_id)
+    if room.state != str(RoomStateEnum.BEFOREGAME.value):
         raise HTTPException(
             status_code=status.HTTP_412_PRECONDITION_FAILED,
             detail=f"This room is not before a game.",
         )
-    db_room.state = str(RoomStateEnum.FIRSTNIGHT.value)
-    session.add(db_room)
-    for db_user in db_room.users:
-        if db_user.state == str(UserStateEnum.WATCHER.value):
-            continue
-        db_user.state = str(UserStateEnum.ALIVE.value)
-        session.add(db_user)
-    session.commit()
-    return db_room
+    state = str(RoomStateEnum.FIRSTNIGHT.value)
+    deadline = datetime.now() + timedelta(minutes=ROOMSTATETIME[state])
+    await session.exec(
+        update(Room)
+        .where(Room.id == room_id)
+        .values(state=state, next_state_update_at=deadline)
+        .execution_options(synchronize_session=False)
+    )
+    # 観戦者以外に役職を配り、全員の状態と役職を1文で更新する
+    roles = assign_roles(room.players())
+    if roles:
+        await session.exec(
+            update(User)
+            .where(User.id.in_(roles))
+            .values(
+                state=str(UserStateEnum.ALIVE.value),
+                role_key=case(roles, value=User.id),
+            )
+            .execution_options(synchronize_session=False)
+        )
+    await session.commit()
+    user_cache.invalidate_room(room_id)
+    message_log.invalidate_room(room_id)
+    room_states.start_game(room_id, state, deadline, roles)
+    alive_counter.start(room_id, roles.values())
+    publish_alive([room_id])
+    phase_engine.schedule(room_id, deadline)
+    publish_state(room_id, state, deadline)
+    return await get_room_with_users(session, room_id)
 
 
 @app.post("/rooms/{room_id}/game/skip/", response_model=RoomPublic)
-def game_skip(
+async def game_skip(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
     room_id: int,
 ):
-    update_by_time(session=session)
-    user = get_user(session_token=session_token, session=session)
-    if user.room is None:
+    user = await get_user_snapshot(session_token=session_token, session=session)
+    if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"You have not entered a room.",
         )
-    room = user.room
-    if room.state != (
-        str(RoomStateEnum.CLOSED.value)
-        or str(RoomStateEnum.BEFOREGAME.value)
-        or str(RoomStateEnum.AFTERGAME.value)
-    ):
-        room.state = str(ROOMSTATECYCLE[room.state])
-        room.next_state_update_at = datetime.now() + timedelta(
-            minutes=ROOMSTATETIME[room.state]
+    room_id = user.room_id
+    # 受け付けるかどうかはroom_statesで判定し、DBからは応答を作るときだけ読む
+    room = await get_room_state(session, room_id)
+    # 開始前・終了後の部屋を飛ばすとclose_roomの後片付けを経ずにCLOSEDになるので、ゲーム中だけ受け付ける
+    if room.state not in ROOMINGAMESTATES:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f"This room is not in Game.",
         )
-        session.add(room)
-        session.commit()
-    return room
+    ended = [(room_id, room.state, room.deadline)]
+    state = str(ROOMSTATECYCLE[room.state])
+    deadline = datetime.now() + timedelta(minutes=ROOMSTATETIME[state])
+    # 状態遷移と同じく、読んだときの状態のままなら進める。
+    # 先にphase_engineや他のリクエストが進めていたら、処刑・襲撃も含めて何もしない
+    if room_id not in await claim_rooms(session, ended, [(room_id, state, deadline)]):
+        await session.rollback()
+        room_states.discard(room_id)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"This room has already advanced.",
+        )
+    deaths = await apply_votes(session, ended)
+    winners = alive_counter.winners(deaths)
+    if winners:
+        state = str(RoomStateEnum.AFTERGAME.value)
+        deadline = await end_games(session, winners, datetime.now())
+    await session.commit()
+    room_states.advance([(room_id, state, deadline)])
+    finish_votes(ended, deaths)
+    finish_games(winners)
+    publish_alive({room_id for room_id, _, _ in deaths} | set(winners))
+    message_log.invalidate_room(room_id)
+    phase_engine.schedule(room_id, deadline)
+    publish_state(room_id, state, deadline)
+    return await get_room_with_users(session, room_id)
 
 
 @app.post("/rooms/{room_id}/game/end/", response_model=RoomPublic)
-def game_end(
+async def game_end(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
     room_id: int,
 ):
-    update_by_time(session=session)
-    user = get_user(session_token=session_token, session=session)
+    user = await get_user_snapshot(session_token=session_token, session=session)
     if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -392,110 +623,431 @@ def game_end(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"You can not update the room setting that you are not in.",
         )
-    db_room = session.exec(select(Room).where(Room.id == room_id)).one()
-    if db_room.state != (
-        str(RoomStateEnum.DAYTIME.value)
-        or str(RoomStateEnum.FIRSTNIGHT.value)
-        or str(RoomStateEnum.NIGHT.value)
-        or str(RoomStateEnum.SCONDMORNING.value)
-        or str(RoomStateEnum.SUNSET.value)
-        or str(RoomStateEnum.MORNING.value)
-    ):
+    room = await get_room_state(session, room_id)
+    if room.state not in ROOMINGAMESTATES:
         raise HTTPException(
             status_code=status.HTTP_412_PRECONDITION_FAILED,
             detail=f"This room is not in Game.",
         )
-    db_room.state = str(RoomStateEnum.AFTERGAME.value)
-    for db_user in db_room.users:
-        if db_user.state == str(UserStateEnum.WATCHER.value):
-            continue
-        db_user.state = str(UserStateEnum.OUTOFPLAY.value)
-        session.add(db_user)
-    session.add(db_room)
-    session.commit()
-    return db_room
+    deadline = await end_games(session, {room_id: None}, datetime.now())
+    await session.commit()
+    room_states.advance([(room_id, str(RoomStateEnum.AFTERGAME.value), deadline)])
+    finish_games([room_id])
+    publish_alive([room_id])
+    vote_tally.discard(room_id)
+    message_log.invalidate_room(room_id)
+    phase_engine.schedule(room_id, deadline)
+    publish_state(room_id, str(RoomStateEnum.AFTERGAME.value), deadline)
+    return await get_room_with_users(session, room_id)
+
+
+# 投票・襲撃の共通処理。票は行として追記し、手元の得票数はvote_tallyで差分だけ更新して他のワーカーにも配る
+async def cast_vote(
+    session: AsyncSession,
+    session_token: str,
+    room_id: int,
+    vote: VoteCreate,
+    kind: str,
+) -> Vote:
+    user = await get_user_snapshot(session_token=session_token, session=session)
+    if user.room_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"You have not entered a room.",
+        )
+    if user.room_id != room_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"You can not vote in the room that you are not in.",
+        )
+    # 部屋の状態・生存者・役職はroom_statesから判定し、票の書き込み以外でDBに問い合わせない
+    room = await get_room_state(session, room_id)
+    if user.id not in room.alive:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"You are not alive.",
+        )
+    if not can(room.roles.get(user.id), room.state, VOTEKINDACTION[kind]):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"You can not {kind.lower()} now.",
+        )
+    target_id = vote.target_id
+    if target_id not in room.members:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The target is not in this room.",
+        )
+    if target_id not in room.alive or target_id == user.id:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f"You can not choose this target.",
+        )
+    if kind == str(VoteKindEnum.ATTACK.value) and RoleGroupWolf.name in ROLETOGROUP.get(
+        room.roles.get(target_id), []
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f"Wolves can not attack a wolf.",
+        )
+    # 期限を過ぎた票は、状態の遷移がまだでも集計に入れない
+    deadline = room.deadline
+    if datetime.now() >= deadline:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f"Voting has closed.",
+        )
+    db_vote = Vote(room_id=room_id, user_id=user.id, target_id=target_id, kind=kind)
+    session.add(db_vote)
+    await session.commit()
+    vote_tally.cast(room_id, kind, deadline, user.id, target_id, db_vote.id)
+    publish_vote(room_id, kind, deadline, user.id, target_id, db_vote.id)
+    return db_vote
 
 
-# TODO target_groupをroomのstateとuserのroleによって動的に決定する
-@app.get("/messages/", response_model=list[MessagePublic])
-def read_messages(
+# 夕方に処刑先を投票する。NIGHTに移るときに最多票の参加者が処刑される
+@app.post("/rooms/{room_id}/game/vote/", response_model=VotePublic)
+async def game_vote(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
+    session_token: str = Cookie(None),
+    room_id: int,
+    vote: VoteCreate,
+):
+    return await cast_vote(
+        session, session_token, room_id, vote, str(VoteKindEnum.VOTE.value)
+    )
+
+
+# 夜に人狼が襲撃先を選ぶ。MORNINGに移るときに最多票の参加者が襲撃される
+@app.post("/rooms/{room_id}/game/attack/", response_model=VotePublic)
+async def game_attack(
+    *,
+    session: AsyncSession = Depends(get_session),
+    session_token: str = Cookie(None),
+    room_id: int,
+    vote: VoteCreate,
+):
+    return await cast_vote(
+        session, session_token, room_id, vote, str(VoteKindEnum.ATTACK.value)
+    )
+
+
+# since_id / before_id はix_message_room_group_idを使ったキーセットページング。
+# 手元にある最新のidをsince_idに渡せば新着分だけを取得できる
+async def select_messages(
+    session: AsyncSession,
+    room_id: int,
+    groups: Tuple[str, ...],
+    offset: int,
+    limit: int,
+    since_id: int | None,
+    before_id: int | None,
+) -> List[Message]:
+    # 閲覧できるグループの絞り込みまでSQLで行い、ix_message_room_group_idの範囲検索で済ませる。
+    # 発言者は件数によらず1回のクエリでまとめて読み込む
+    statement = (
+        select(Message)
+        .where(Message.room_id == room_id, Message.target_group.in_(groups))
+        .options(selectinload(Message.user))
+    )
+    if since_id is not None:
+        statement = statement.where(Message.id > since_id)
+    if before_id is not None:
+        statement = statement.where(Message.id < before_id)
+    if before_id is not None and since_id is None:
+        # 過去に遡るときは新しい順にlimit件取ってから古い順に並べ直す
+        messages = await session.exec(
+            statement.order_by(Message.id.desc()).limit(limit)
+        )
+        return messages.all()[::-1]
+    messages = await session.exec(
+        statement.order_by(Message.id).offset(offset).limit(limit)
+    )
+    return messages.all()
+
+
+# GET /messages/に載せる部屋。message_logに置いておき、部屋や参加者が変わるまでDBに問い合わせない
+async def get_room_public(session: AsyncSession, room_id: int) -> RoomPublic:
+    room, generation = message_log.room(room_id)
+    if room is None:
+        room = RoomPublic.model_validate(await get_room_with_users(session, room_id))
+        message_log.put_room(room_id, room, generation)
+    return room
+
+
+# 部屋と発言者はメッセージごとに繰り返さず、一覧の外側に1回だけ載せる
+def build_message_page(room: RoomPublic, messages: List[Message]) -> MessagePage:
+    users = {message.user_id: message.user for message in messages}
+    return MessagePage(
+        room=room,
+        users=[UserPublicWithoutName.model_validate(user) for user in users.values()],
+        messages=[MessageCompact.model_validate(message) for message in messages],
+    )
+
+
+# message_logから読んだメッセージの一覧。発言者が部屋を出ていて載せられないときはNoneを返す
+def build_message_page_from_log(
+    room: RoomPublic, messages: List[MessageCompact]
+) -> MessagePage | None:
+    members = {user.id: user for user in room.users or []}
+    users = {}
+    for message in messages:
+        if message.user_id not in members:
+            return None
+        users[message.user_id] = members[message.user_id]
+    return MessagePage(room=room, users=list(users.values()), messages=messages)
+
+
+# 書き込んだメッセージをレスポンスの形にする。idとcreated_atはMessageWriterのINSERT ... RETURNINGで決まっているので、
+# 部屋と発言者はmessage_logに置いた部屋の情報から埋め、DBを読み直さない
+async def build_written_message(
+    session: AsyncSession,
+    model: Type[MessagePublic] | Type[MessageWolf],
+    room: RoomPublic,
+    db_message: Message,
+) -> MessagePublic | MessageWolf:
+    for user in room.users or []:
+        if user.id == db_message.user_id:
+            return model.model_validate(
+                {**db_message.model_dump(), "room": room, "user": user}
+            )
+    return model.model_validate(
+        await get_message_with_relations(session, db_message.id)
+    )
+
+
+MESSAGEWAITMAX = 30  # 秒。ロングポーリングで待てる最長時間
+
+
+# 閲覧できるtarget_groupは役職・部屋のstate・ユーザーのstateで決まる。target_groupを指定するとそのグループだけを返す。
+# waitを指定すると、since_idより新しいメッセージが無い間は最長wait秒まで待ってから返す(ロングポーリング)
+@app.get("/messages/", response_model=MessagePage)
+async def read_messages(
+    *,
+    session: AsyncSession = Depends(get_read_session),
     offset: int = 0,
     limit: int = Query(default=100, le=100),
     session_token: str = Cookie(None),
     target_group: str | None = None,
+    since_id: int | None = None,
+    before_id: int | None = None,
+    wait: float = Query(default=0, ge=0, le=MESSAGEWAITMAX),
 ):
-    update_by_time(session=session)
-    user = get_user(session_token, session)
-    room = session.exec(select(Room).where(Room.id == user.room_id)).one()
-    if room is None:
+    if wait and since_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"wait can only be used with since_id.",
+        )
+
+    user = await get_user_snapshot(session_token, session)
+    if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"You have not entered a room.",
         )
-    target_group = ROLETOGROUP[user.role_key]
-    messages = session.exec(
-        select(Message)
-        .where(Message.room_id == room.id and Message.target_group.in_(target_group))
-        .offset(offset)
-        .limit(limit)
-    ).all()
-    return messages
+    room_id = user.room_id
+    deadline = time.monotonic() + wait
+    while True:
+        # 検索前の版を控えておき、検索と待機の間に書き込まれたメッセージを取りこぼさない
+        version = message_notifier.version(room_id)
+        # 待っている間に部屋の状態が変わることがあるので、閲覧範囲は毎回求め直す
+        room = await get_room_public(session, room_id)
+        groups = visible_groups(user.role_key, room.state, user.state)
+        if target_group is not None:
+            if target_group not in groups:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail=f"You can not read {target_group} messages now.",
+                )
+            groups = (target_group,)
+        # 新着の取得はまずmessage_logから答え、足りないときだけDBを読む。
+        # 他のワーカーも書き込むときは、手元のmessage_logに他のワーカーのメッセージが抜けていることがあるので使わない
+        page = None
+        if not event_bus.remote:
+            messages = message_log.select(
+                room_id, groups, offset, limit, since_id, before_id
+            )
+            if messages is not None:
+                page = build_message_page_from_log(room, messages)
+        if page is None:
+            page = build_message_page(
+                room,
+                await select_messages(
+                    session, room_id, groups, offset, limit, since_id, before_id
+                ),
+            )
+        remaining = deadline - time.monotonic()
+        if page.messages or remaining <= 0:
+            return page
+        # 待っている間はDBを使わないので、トランザクションを終えてコネクションを返す
+        await session.rollback()
+        await message_notifier.wait(room_id, version, remaining)
 
 
 @app.post("/messages/", response_model=MessagePublic)
-def create_message(
+async def create_message(
     *,
     message: MessageCreate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
 ):
-    update_by_time(session=session)
-    user = get_user(session_token, session)
-    if user.room is None:
+    user = await get_user_snapshot(session_token, session)
+    if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"You have not entered a room.",
         )
+    room = await get_room_public(session, user.room_id)
     db_message = Message.model_validate(message)
     db_message.room_id = user.room_id
     db_message.user_id = user.id
-    session.add(db_message)
-    session.commit()
-    session.refresh(db_message)
+    db_message.target_group = message_group(room.state, user.state)
+    # 書き込みはMessageWriterが別のコネクションでまとめて行うので、待っている間はコネクションを返しておく。
+    # 返さないと、同時に書き込むリクエストがプールを使い切ったときに書き込み側がコネクションを取れず止まる
+    await session.rollback()
+    db_message = await message_writer.write(session, db_message)
+    db_message = await build_written_message(session, MessagePublic, room, db_message)
+    publish_message(
+        db_message.room_id,
+        db_message.target_group,
+        db_message.model_dump_json(),
+        db_message.id,
+    )
     return db_message
 
 
 @app.post("/messages/wolf/", response_model=MessageWolf)
-def create_message(
+async def create_message(
     *,
     message: MessageCreate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     session_token: str = Cookie(None),
 ):
-    update_by_time(session=session)
-    user = get_user(session_token, session)
-    if user.room is None:
+    user = await get_user_snapshot(session_token, session)
+    if user.room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"You have not entered a room.",
         )
-    if user.role_key != "wolf":
+    room_state = await get_room_state(session, user.room_id)
+    if user.id not in room_state.alive:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"You are not a wolf.",
+            detail=f"You are not alive.",
         )
-    if user.room.state != str(RoomStateEnum.NIGHT.value):
+    if not can(room_state.roles.get(user.id), room_state.state, ActionFlag.WOLFTALK):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"This is not night.",
+            detail=f"You can not talk with wolves now.",
         )
 
     db_message = Message.model_validate(message)
     db_message.room_id = user.room_id
     db_message.user_id = user.id
-    session.add(db_message)
-    session.commit()
-    session.refresh(db_message)
+    db_message.target_group = RoleGroupWolf.name
+    room = await get_room_public(session, user.room_id)
+    # 書き込みはMessageWriterが別のコネクションでまとめて行うので、待っている間はコネクションを返しておく。
+    # 返さないと、同時に書き込むリクエストがプールを使い切ったときに書き込み側がコネクションを取れず止まる
+    await session.rollback()
+    db_message = await message_writer.write(session, db_message)
+    db_message = await build_written_message(session, MessageWolf, room, db_message)
+    publish_message(
+        db_message.room_id,
+        db_message.target_group,
+        db_message.model_dump_json(),
+        db_message.id,
+    )
     return db_message
+
+
+# 部屋の新着メッセージをpushする。閲覧できるtarget_groupは送るたびにroom_statesの役職・部屋のstate・生死から求め直す
+@app.websocket("/rooms/{room_id}/ws")
+async def room_messages_ws(
+    *,
+    websocket: WebSocket,
+    session: AsyncSession = Depends(get_read_session),
+    session_token: str = Cookie(None),
+    room_id: int,
+):
+    try:
+        user = await get_user_snapshot(session_token, session)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if user.room_id != room_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    async def audience() -> Tuple[str, ...]:
+        room = room_states.peek(room_id)
+        if room is None:
+            room = await room_states.get(session, room_id)
+            # 接続中はDBを使わないので、読み込んだらすぐにコネクションを返す
+            await session.close()
+        if room is None or user.id not in room.members:
+            return ()
+        return visible_groups(
+            room.roles.get(user.id), room.state, room.user_state(user.id)
+        )
+
+    # 接続中はDBを使わないので、ここでセッションを閉じてコネクションを返す
+    await session.close()
+    await websocket.accept()
+    await message_hub.serve(room_id, websocket, audience)
+
+
+SSEKEEPALIVE = 15  # 秒。プロキシに切られないようにコメント行を送る間隔
+
+
+# 部屋の状態遷移をServer-Sent Eventsで流す。接続直後に現在の状態を1件送り、部屋がCLOSEDになったら終了する
+@app.get("/rooms/{room_id}/events")
+async def room_events(
+    *,
+    session: AsyncSession = Depends(get_read_session),
+    room_id: int,
+):
+    # 現在の状態を読む前に購読しておき、その間の遷移を取りこぼさないようにする
+    subscriber = room_event_broker.subscribe(room_id)
+    room = await session.get(Room, room_id)
+    if room is None:
+        room_event_broker.unsubscribe(room_id, subscriber)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"This room does not exist.",
+        )
+    current = (
+        room.state,
+        RoomStateEvent(
+            id=room.id, state=room.state, next_state_update_at=room.next_state_update_at
+        ).model_dump_json(),
+    )
+    # 配信中はDBを使わないので、ここでセッションを閉じてコネクションを返す
+    await session.close()
+    closed = str(RoomStateEnum.CLOSED.value)
+
+    async def stream():
+        try:
+            event = current
+            while True:
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    state, payload = event
+                    yield f"event: state\ndata: {payload}\n\n"
+                    if state == closed:
+                        return
+                try:
+                    event = await asyncio.wait_for(
+                        subscriber[1].get(), timeout=SSEKEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    event = None
+        finally:
+            room_event_broker.unsubscribe(room_id, subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
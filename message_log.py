@@ -0,0 +1,204 @@
+import asyncio
+import threading
+from collections import deque
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import Message, MessageCompact, RoomPublic
+from typing import Deque, Dict, List, Set, Tuple
+
+
+# 1つの部屋の直近のメッセージ。entriesはidの昇順で、covered_afterより大きいidのメッセージはすべてentriesにある。
+# roomはGET /messages/に載せる部屋の情報で、部屋や参加者が変わったらgenerationを進めて捨てる
+class RoomLog:
+    __slots__ = ("entries", "covered_after", "room", "generation")
+
+    def __init__(self, maxlen: int):
+        self.entries: Deque[Tuple[str, MessageCompact]] = deque(maxlen=maxlen)
+        self.covered_after: int | None = None
+        self.room: RoomPublic | None = None
+        self.generation = 0
+
+
+# 部屋ごとのリングバッファ。このプロセスが書き込んだメッセージを新しい方からmaxlen件持ち、
+# since_id以降の新着の読み込みをDBに問い合わせずに返す。
+# 書き込みはすべてMessageWriterを通る前提なので、最初に書き込んだメッセージより後はバッファだけで揃う
+class MessageLog:
+    def __init__(self, maxlen: int = 256):
+        self._maxlen = maxlen
+        self._rooms: Dict[int, RoomLog] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, room_id: int) -> RoomLog:
+        log = self._rooms.get(room_id)
+        if log is None:
+            log = self._rooms[room_id] = RoomLog(self._maxlen)
+        return log
+
+    # messagesはidの昇順でコミット済みのもの
+    def extend(self, messages: List[Message]):
+        with self._lock:
+            for message in messages:
+                log = self._get(message.room_id)
+                if log.covered_after is None:
+                    log.covered_after = message.id - 1
+                if len(log.entries) == self._maxlen:
+                    log.covered_after = log.entries[0][1].id
+                log.entries.append(
+                    (message.target_group, MessageCompact.model_validate(message))
+                )
+
+    # バッファだけで答えられないときはNoneを返すので、呼び出し側でDBから読む
+    def select(
+        self,
+        room_id: int,
+        groups: Tuple[str, ...],
+        offset: int,
+        limit: int,
+        since_id: int | None,
+        before_id: int | None,
+    ) -> List[MessageCompact] | None:
+        with self._lock:
+            log = self._rooms.get(room_id)
+            if log is None or log.covered_after is None:
+                return None
+            if since_id is None or since_id < log.covered_after:
+                return None
+            messages = []
+            for target_group, message in log.entries:
+                if message.id <= since_id or target_group not in groups:
+                    continue
+                if before_id is not None and message.id >= before_id:
+                    break
+                if offset:
+                    offset -= 1
+                    continue
+                messages.append(message)
+                if len(messages) >= limit:
+                    break
+            return messages
+
+    def room(self, room_id: int) -> Tuple[RoomPublic | None, int]:
+        with self._lock:
+            log = self._rooms.get(room_id)
+            if log is None:
+                return None, 0
+            return log.room, log.generation
+
+    # DBから読み直した部屋を置く。読んでいる間にinvalidate_roomされていたら置かない
+    def put_room(self, room_id: int, room: RoomPublic, generation: int):
+        with self._lock:
+            log = self._get(room_id)
+            if log.generation == generation:
+                log.room = room
+
+    def invalidate_room(self, room_id: int):
+        with self._lock:
+            log = self._rooms.get(room_id)
+            if log is not None:
+                log.room = None
+                log.generation += 1
+
+    def discard(self, room_id: int):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+
+message_log = MessageLog()
+
+
+# メッセージの書き込みをinterval秒ごとにまとめ、1回のINSERTと1回のコミットで挿入する。
+# 最初に書き込んだリクエストがその回の書き込みを予約し、同じ間に来たものは相乗りして結果を待つ。
+# 書き込み中に来たものは次の回にまとめ、前の回のコミットとmessage_logへの追加が終わってから書き込む。
+# 回が重なると、後の回が先にコミットしてmessage_logのidの昇順が崩れ、since_idで読む側が前の回を取りこぼす。
+# バックグラウンドのタスクを常駐させないので、起動・停止の手順はいらない
+class MessageWriter:
+    def __init__(self, log: MessageLog, interval: float = 0.005, max_rows: int = 500):
+        self._log = log
+        self._interval = interval
+        # 1文あたりの行数。SQLiteのプレースホルダ数の上限を超えないようにする
+        self._max_rows = max_rows
+        self._batches: Dict[
+            Tuple[asyncio.AbstractEventLoop, AsyncEngine],
+            List[Tuple[Message, asyncio.Future]],
+        ] = {}
+        # 書き込みのタスクが走っている(loop, engine)
+        self._flushing: Set[Tuple[asyncio.AbstractEventLoop, AsyncEngine]] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    # コミットしてidとcreated_atが決まったmessageを返す。接続先は呼び出し元のセッションに合わせる
+    async def write(self, session: AsyncSession, message: Message) -> Message:
+        loop = asyncio.get_running_loop()
+        key = (loop, session.bind)
+        future = loop.create_future()
+        self._batches.setdefault(key, []).append((message, future))
+        if key not in self._flushing:
+            self._flushing.add(key)
+            task = loop.create_task(self._flush_later(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await future
+
+    # 複数行のINSERT ... RETURNING 1文で挿入する。1文の中ではidが行の順に昇順で振られるので、
+    # 返ってきたidを並べ替えれば行と対応が付く
+    @staticmethod
+    async def _insert(session: AsyncSession, messages: List[Message]):
+        ids = await session.exec(
+            insert(Message)
+            .values(
+                [
+                    {
+                        "content": message.content,
+                        "room_id": message.room_id,
+                        "user_id": message.user_id,
+                        "target_user": message.target_user,
+                        "target_group": message.target_group,
+                        "created_at": message.created_at,
+                    }
+                    for message in messages
+                ]
+            )
+            .returning(Message.id)
+        )
+        for message, id in zip(messages, sorted(ids.scalars().all())):
+            message.id = id
+
+    # 書き込んでいる間に次の回が溜まっていれば、続けて書き込む
+    async def _flush_later(self, key: Tuple[asyncio.AbstractEventLoop, AsyncEngine]):
+        try:
+            await asyncio.sleep(self._interval)
+            while True:
+                batch = self._batches.pop(key, None)
+                if not batch:
+                    return
+                await self._flush(key[1], batch)
+        finally:
+            self._flushing.discard(key)
+
+    async def _flush(
+        self, engine: AsyncEngine, batch: List[Tuple[Message, asyncio.Future]]
+    ):
+        messages = [message for message, _ in batch]
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                for start in range(0, len(messages), self._max_rows):
+                    await self._insert(
+                        session, messages[start : start + self._max_rows]
+                    )
+                await session.commit()
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self._log.extend(messages)
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message)
+
+
+message_writer = MessageWriter(message_log)
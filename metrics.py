@@ -0,0 +1,222 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Dict, Iterator, List, Tuple
+
+# 秒。ロングポーリングは最長MESSAGEWAITMAX(30秒)まで待つので上の方も刻んでおく
+DURATIONBUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+STATEMENTBUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64)
+
+
+# 1回のリクエスト(または状態遷移)で発行したSQLの数と、その実行にかかった時間
+class QueryStats:
+    __slots__ = ("statements", "db_time", "started_at")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.started_at = time.perf_counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+# 実行中の処理のQueryStats。SQLAlchemyのAsyncSessionはgreenletに呼び出し元のcontextを引き継ぐので、
+# イベントフックからリクエストごとに数え分けられる。
+# MessageWriterのまとめ書きは最初に書き込んだリクエストのcontextで走るので、そのリクエストに数える
+_current: contextvars.ContextVar[QueryStats | None] = contextvars.ContextVar(
+    "_current", default=None
+)
+
+
+# エンジンごとではなくEngineクラスに付けるので、テストで差し替えたエンジンや読み取り用のエンジンも数える
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("metrics_started_at", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    started = conn.info.get("metrics_started_at")
+    if not started:
+        return
+    stats.statements += 1
+    stats.db_time += time.perf_counter() - started.pop()
+
+
+# 失敗した文にはafter_cursor_executeが呼ばれないので、積んだ開始時刻をここで捨てる
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is None:
+        return
+    started = context.connection.info.get("metrics_started_at")
+    if started:
+        started.pop()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else str(value)
+
+
+class HistogramSeries:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, buckets: int):
+        # 各バケットにちょうど入った数。累積は出力するときに取る
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0
+
+
+# Prometheusのhistogram。ラベルの値の組ごとにバケットを持つ
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DURATIONBUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], HistogramSeries] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = HistogramSeries(len(self.buckets))
+            series.counts[index] += 1
+            series.sum += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [
+                (labels, list(entry.counts), entry.sum)
+                for labels, entry in sorted(self._series.items())
+            ]
+        for labels, counts, total in series:
+            pairs = [
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.labelnames, labels)
+            ]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = ",".join(pairs + [f'le="{_format_value(bound)}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {cumulative}")
+            suffix = "{" + ",".join(pairs) + "}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {_format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+# GET /metricsで出す計測値。routeはパスの値ではなく"/rooms/{room_id}/game/start/"のようなテンプレートにして、
+# 時系列が部屋の数だけ増えないようにする
+class Metrics:
+    def __init__(self):
+        labels = ("method", "route")
+        self.request_duration = Histogram(
+            "zinro_http_request_duration_seconds",
+            "Wall time to produce the response.",
+            labels + ("status",),
+        )
+        self.request_statements = Histogram(
+            "zinro_http_request_db_statements",
+            "SQL statements executed per request.",
+            labels,
+            STATEMENTBUCKETS,
+        )
+        self.request_db_duration = Histogram(
+            "zinro_http_request_db_duration_seconds",
+            "Time spent executing SQL per request.",
+            labels,
+        )
+        self.phase_advance_duration = Histogram(
+            "zinro_phase_advance_duration_seconds",
+            "Wall time of one phase_engine pass over the due rooms.",
+        )
+        self.phase_advance_statements = Histogram(
+            "zinro_phase_advance_db_statements",
+            "SQL statements executed per phase_engine pass.",
+            buckets=STATEMENTBUCKETS,
+        )
+        self.phase_advance_db_duration = Histogram(
+            "zinro_phase_advance_db_duration_seconds",
+            "Time spent executing SQL per phase_engine pass.",
+        )
+        self._histograms = (
+            self.request_duration,
+            self.request_statements,
+            self.request_db_duration,
+            self.phase_advance_duration,
+            self.phase_advance_statements,
+            self.phase_advance_db_duration,
+        )
+
+    @contextmanager
+    def track(self) -> Iterator[QueryStats]:
+        stats = QueryStats()
+        token = _current.set(stats)
+        try:
+            yield stats
+        finally:
+            _current.reset(token)
+
+    def observe_request(self, method: str, route: str, status: int, stats: QueryStats):
+        self.request_duration.observe(stats.elapsed(), method, route, str(status))
+        self.request_statements.observe(stats.statements, method, route)
+        self.request_db_duration.observe(stats.db_time, method, route)
+
+    def observe_phase_advance(self, stats: QueryStats):
+        self.phase_advance_duration.observe(stats.elapsed())
+        self.phase_advance_statements.observe(stats.statements)
+        self.phase_advance_db_duration.observe(stats.db_time)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for histogram in self._histograms:
+            histogram.clear()
+
+
+metrics = Metrics()
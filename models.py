@@ -1,24 +1,9 @@
 from sqlmodel import SQLModel, Field, Relationship, text
-from typing import List, Optional, Dict
+from sqlalchemy import Index
+from typing import List, Optional, Dict, Tuple, Type
 from datetime import datetime, timedelta
 from uuid import uuid4
-from enum import Enum
-
-
-# Roleは会話の閲覧権限のスコープの指定、action配下の各エンドポイントの利用権限のスコープの指定を行う
-class RoleBase:
-    pass
-
-
-class RoleWolf(RoleBase):
-    pass
-
-
-class RoleVillager(RoleBase):
-    pass
-
-
-RoleClassList = {"villager": RoleVillager, "wolf": RoleWolf}
+from enum import Enum, IntFlag, auto
 
 
 # Room 👇
@@ -58,6 +43,16 @@ ROOMSTATECYCLE = {
     RoomStateEnum.CLOSED.value: None,
 }
 
+# ゲームが進行中の状態
+ROOMINGAMESTATES = {
+    RoomStateEnum.FIRSTNIGHT.value,
+    RoomStateEnum.SECONDMORNING.value,
+    RoomStateEnum.DAYTIME.value,
+    RoomStateEnum.SUNSET.value,
+    RoomStateEnum.NIGHT.value,
+    RoomStateEnum.MORNING.value,
+}
+
 
 class RoomBase(SQLModel):
     name: str
@@ -65,11 +60,23 @@ class RoomBase(SQLModel):
 
 
 class Room(RoomBase, table=True):
+    # 時間経過による更新対象の検索用。CLOSEDの部屋はもう更新されないのでインデックスから除外する
+    __table_args__ = (
+        Index(
+            "ix_room_due",
+            "next_state_update_at",
+            "state",
+            postgresql_where=text(f"state != '{RoomStateEnum.CLOSED.value}'"),
+            sqlite_where=text(f"state != '{RoomStateEnum.CLOSED.value}'"),
+        ),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     state: str | None = Field(
         default=str(RoomStateEnum.BEFOREGAME.value), nullable=False
     )
     detail_of_role: str | None = None
+    winner: str | None = None  # 勝ったROLETOGROUPのグループ。手動で終えたゲームではNone
     created_at: datetime | None = Field(
         default_factory=lambda: datetime.now(), nullable=False
     )
@@ -89,6 +96,7 @@ class RoomPublic(RoomBase):
     id: int
     state: str | None
     detail_of_role: str | None
+    winner: str | None = None
     created_at: datetime
     updated_at: datetime
     users: List["UserPublicWithoutName"] | None
@@ -104,6 +112,12 @@ class RoomUpdate(SQLModel):
     detail_of_role: str | None = None
 
 
+class RoomStateEvent(SQLModel):
+    id: int
+    state: str
+    next_state_update_at: datetime
+
+
 # Room 👆
 
 
@@ -164,13 +178,19 @@ class MessageBase(SQLModel):
 
 
 class Message(MessageBase, table=True):
+    # 部屋・閲覧グループごとにidの範囲で新着を取り出すためのインデックス
+    __table_args__ = (
+        Index("ix_message_room_group_id", "room_id", "target_group", "id"),
+    )
+
     id: int = Field(default=None, primary_key=True)
     room_id: int = Field(default=None, foreign_key="room.id")
     room: Room = Relationship(back_populates="messages")
     user_id: int = Field(default=None, foreign_key="user.id")
     user: User = Relationship(back_populates="messages")
     target_user: str | None = None
-    target_group: str | None = None
+    # 閲覧できるRoleGroupのname。全体への発言はvillagers
+    target_group: str | None = Field(default="villagers", nullable=False)
     created_at: datetime = Field(default_factory=lambda: datetime.now(), nullable=False)
 
 
@@ -196,6 +216,22 @@ class MessageWolf(MessageBase):
     target_group: str = "wolves"
 
 
+# 一覧用。部屋と発言者はidだけを持ち、MessagePageの側に1回だけ載せる
+class MessageCompact(MessageBase):
+    id: int
+    room_id: int
+    user_id: int
+    created_at: datetime
+    target_user: str | None = None
+    target_group: str | None = None
+
+
+class MessagePage(SQLModel):
+    room: RoomPublic
+    users: List[UserPublicWithoutName]
+    messages: List[MessageCompact]
+
+
 class MessageCreate(MessageBase):
     content: str
 
@@ -207,36 +243,151 @@ class MessageUpdate(SQLModel):
 # Message 👆
 
 
-# Role　👇
-class Role:
-    name: str
-    role_group: "RoleGroup"
-    role_type: "RoleType"
+# Vote 👇
+class VoteKindEnum(Enum):
+    VOTE = "Vote"  # 夕方の処刑先
+    ATTACK = "Attack"  # 夜の襲撃先
 
 
-class Wolf(Role):
-    name = "wolf"
+class VoteBase(SQLModel):
+    target_id: int
 
 
-# Role　👆
+class Vote(VoteBase, table=True):
+    # 追記のみ。投票先を変えたときも行を足し、同じ参加者の票は最後の行を有効とする
+    __table_args__ = (Index("ix_vote_room_kind_id", "room_id", "kind", "id"),)
 
+    id: int | None = Field(default=None, primary_key=True)
+    room_id: int = Field(foreign_key="room.id")
+    user_id: int = Field(foreign_key="user.id")
+    target_id: int = Field(foreign_key="user.id")
+    kind: str = Field(nullable=False)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(), nullable=False)
 
-# RoleGroup　👇
-ROLETOGROUP = {
-    "villager": ["villagers"],
-    "wolf": ["wolves", "villagers"],
-}
+
+class VotePublic(VoteBase):
+    id: int
+    room_id: int
+    user_id: int
+    kind: str
+    created_at: datetime
+
+
+class VoteCreate(VoteBase):
+    pass
+
+
+# Vote 👆
 
 
+# RoleGroup　👇
+# 会話のtarget_groupと、勝敗判定で数える陣営の単位
 class RoleGroup:
     name: str
 
 
+class RoleGroupVillager(RoleGroup):
+    name = "villagers"
+
+
 class RoleGroupWolf(RoleGroup):
-    name = "wolf"
+    name = "wolves"
+
+
+# 死亡者と観戦者の会話。ゲーム中は生存者には見えない
+class RoleGroupDead(RoleGroup):
+    name = "dead"
 
 
 # RoleGroup　👆
+
+
+# Role　👇
+# 役職ごとに、部屋の状態ごとに使えるアクション。roles.pyで(role_key, state)の表に展開してから使う
+class ActionFlag(IntFlag):
+    NONE = 0
+    VOTE = auto()  # 処刑先の投票
+    ATTACK = auto()  # 襲撃先の選択
+    WOLFTALK = auto()  # 人狼同士の会話
+    DIVINE = auto()  # 占い
+    GUARD = auto()  # 護衛
+
+
+# Roleは会話の閲覧権限のスコープの指定、action配下の各エンドポイントの利用権限のスコープの指定を行う
+class RoleBase:
+    key: str
+    groups: Tuple[Type[RoleGroup], ...] = (RoleGroupVillager,)  # 閲覧できるtarget_group
+    team: Type[RoleGroup] = RoleGroupVillager  # 勝ったときに勝者となる陣営
+    min_players: int | None = (
+        None  # この人数以上のゲームで1人配役する。Noneは人狼・村人の枠で配る
+    )
+    actions: Dict[str, ActionFlag] = {RoomStateEnum.SUNSET.value: ActionFlag.VOTE}
+
+
+RoleClassList: Dict[str, Type[RoleBase]] = {}
+ROLETOGROUP: Dict[str, List[str]] = {}
+
+
+# 役職を追加するときはRoleBaseを継承してこのデコレータで登録する
+def register_role(role: Type[RoleBase]) -> Type[RoleBase]:
+    RoleClassList[role.key] = role
+    ROLETOGROUP[role.key] = [group.name for group in role.groups]
+    return role
+
+
+@register_role
+class RoleVillager(RoleBase):
+    key = "villager"
+
+
+@register_role
+class RoleWolf(RoleBase):
+    key = "wolf"
+    groups = (RoleGroupWolf, RoleGroupVillager)
+    team = RoleGroupWolf
+    actions = {
+        RoomStateEnum.SUNSET.value: ActionFlag.VOTE,
+        RoomStateEnum.NIGHT.value: ActionFlag.ATTACK | ActionFlag.WOLFTALK,
+    }
+
+
+@register_role
+class RoleSeer(RoleBase):
+    key = "seer"
+    min_players = 5
+    actions = {
+        RoomStateEnum.SUNSET.value: ActionFlag.VOTE,
+        RoomStateEnum.NIGHT.value: ActionFlag.DIVINE,
+    }
+
+
+@register_role
+class RoleKnight(RoleBase):
+    key = "knight"
+    min_players = 6
+    actions = {
+        RoomStateEnum.SUNSET.value: ActionFlag.VOTE,
+        RoomStateEnum.NIGHT.value: ActionFlag.GUARD,
+    }
+
+
+@register_role
+class RoleMedium(RoleBase):
+    key = "medium"
+    min_players = 8
+
+
+# 人狼の陣営だが人狼の会話は見えず、勝敗判定でも人間として数える
+@register_role
+class RoleMadman(RoleBase):
+    key = "madman"
+    min_players = 9
+    team = RoleGroupWolf
+
+
+# Role　👆
+
+
 # RoleType　👇
 class RoleType:
     name: str
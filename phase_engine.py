@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import logging
+import threading
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import engine
+from scheduler import advance_due_rooms
+from event_bus import event_bus, publish_state
+from voting import vote_tally
+from metrics import metrics
+from models import Room, RoomStateEnum
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# 部屋の状態遷移をリクエストから切り離し、バックグラウンドで次の期限まで眠って実行する。
+# ヒープには(next_state_update_at, room_id)を積み、期限が来たら期限切れの部屋をまとめて1回で更新する。
+# game_skipなどで期限が変わった部屋の古いエントリはそのまま残るが、更新時にDB側の期限で再判定するので害はない。
+class PhaseEngine:
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession] | None = None,
+        max_sleep: float = 60.0,
+        settle: float | None = None,
+    ):
+        self._session_factory = session_factory or (
+            lambda: AsyncSession(engine, expire_on_commit=False)
+        )
+        # 他のプロセスが期限を変えた場合に備えて、最長でもmax_sleep秒ごとに起きる
+        self._max_sleep = max_sleep
+        # 期限の直前に他のワーカーで受けた票がイベントバスで届くのを待ってから集計する
+        if settle is None:
+            settle = 0.5 if event_bus.remote else 0.0
+        self._settle = settle
+        self._heap: List[Tuple[datetime, int]] = []
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    # 起こすのはstartしたループで行う。サーバーではエンドポイントと同じループだが、
+    # TestClientはリクエストごとに別のスレッドでループを動かすので、call_soon_threadsafeで渡す
+    def schedule(self, room_id: int, deadline: datetime):
+        with self._lock:
+            earliest = self._heap[0][0] if self._heap else None
+            heapq.heappush(self._heap, (deadline, room_id))
+        if self._loop is None or self._wakeup is None:
+            return
+        if earliest is None or deadline < earliest:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await self._load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+
+    async def _load(self):
+        async with self._session_factory() as session:
+            rows = (
+                await session.exec(
+                    select(Room.id, Room.next_state_update_at).where(
+                        Room.state != str(RoomStateEnum.CLOSED.value)
+                    )
+                )
+            ).all()
+            await vote_tally.load(session)
+        with self._lock:
+            self._heap = [(deadline, room_id) for room_id, deadline in rows]
+            heapq.heapify(self._heap)
+
+    def _seconds_until_next(self, now: datetime) -> float:
+        with self._lock:
+            if not self._heap:
+                return self._max_sleep
+            delay = (self._heap[0][0] - now).total_seconds() + self._settle
+        return min(max(delay, 0.0), self._max_sleep)
+
+    def _pop_due(self, now: datetime) -> int:
+        count = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                heapq.heappop(self._heap)
+                count += 1
+        return count
+
+    async def _advance(self, now: datetime) -> List[Tuple[int, str, datetime]]:
+        with metrics.track() as stats:
+            try:
+                async with self._session_factory() as session:
+                    return await advance_due_rooms(session, now)
+            finally:
+                metrics.observe_phase_advance(stats)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._seconds_until_next(datetime.now())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                continue
+            except asyncio.TimeoutError:
+                pass
+            now = datetime.now() - timedelta(seconds=self._settle)
+            self._pop_due(now)
+            try:
+                advanced = await self._advance(now)
+            except Exception:
+                logger.exception("Failed to advance rooms.")
+                continue
+            for room_id, state, deadline in advanced:
+                publish_state(room_id, state, deadline)
+                if state != str(RoomStateEnum.CLOSED.value):
+                    self.schedule(room_id, deadline)
+
+
+phase_engine = PhaseEngine()
@@ -0,0 +1,200 @@
+import asyncio
+import threading
+from fastapi import WebSocket, WebSocketDisconnect
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+# 接続しているユーザーがいま閲覧できるtarget_groupを返す。役職や生死はゲーム中に変わるので、配信のたびに呼ぶ
+Audience = Callable[[], Awaitable[Tuple[str, ...]]]
+
+
+# 1つのWebSocket接続。送信は接続ごとのキューを1つのタスクが順番に捌くので、メッセージの順序が入れ替わらない
+class RoomConnection:
+    __slots__ = ("websocket", "audience", "loop", "queue")
+
+    def __init__(self, websocket: WebSocket, audience: Audience, max_queue: int):
+        self.websocket = websocket
+        self.audience = audience
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+
+    # messageは(target_group, payload)
+    def push(self, message: Tuple[str | None, str]):
+        if self.queue.full():
+            # 受信が追いつかない接続は切断し、クライアントにGET /messages/で取り直してもらう
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(message)
+
+
+# 部屋ごとの接続を持つ。配信時はメッセージを一度だけシリアライズして部屋の全接続のキューに積み、
+# 送る直前に接続ごとのaudienceで閲覧できるかを確かめる。
+# 閲覧範囲を接続したときに決めてしまうと、開始前に接続した村人にもゲーム中の人狼の会話が届いてしまう
+class MessageHub:
+    def __init__(self, max_queue: int = 256):
+        self._max_queue = max_queue
+        self._rooms: Dict[int, Set[RoomConnection]] = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self, room_id: int, websocket: WebSocket, audience: Audience
+    ) -> RoomConnection:
+        connection = RoomConnection(websocket, audience, self._max_queue)
+        with self._lock:
+            self._rooms.setdefault(room_id, set()).add(connection)
+        return connection
+
+    def remove(self, room_id: int, connection: RoomConnection):
+        with self._lock:
+            connections = self._rooms.get(room_id)
+            if connections is None:
+                return
+            connections.discard(connection)
+            if not connections:
+                del self._rooms[room_id]
+
+    def connections(self, room_id: int) -> List[RoomConnection]:
+        with self._lock:
+            return list(self._rooms.get(room_id, ()))
+
+    # 接続はそれぞれ自分のイベントループで送る。サーバーでは呼び出し元と同じループだが、
+    # TestClientは接続やリクエストごとに別のスレッドでループを動かすので、call_soon_threadsafeで渡す
+    def publish(self, room_id: int, target_group: str | None, payload: str):
+        for connection in self.connections(room_id):
+            connection.loop.call_soon_threadsafe(
+                connection.push, (target_group, payload)
+            )
+
+    async def serve(self, room_id: int, websocket: WebSocket, audience: Audience):
+        connection = self.add(room_id, websocket, audience)
+        sender = asyncio.create_task(self._send(connection))
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.remove(room_id, connection)
+            sender.cancel()
+
+    async def _send(self, connection: RoomConnection):
+        while True:
+            message = await connection.queue.get()
+            if message is None:
+                await connection.websocket.close()
+                return
+            target_group, payload = message
+            if (
+                target_group is not None
+                and target_group not in await connection.audience()
+            ):
+                continue
+            await connection.websocket.send_text(payload)
+
+
+message_hub = MessageHub()
+
+
+# ロングポーリング用。部屋ごとに版番号を持ち、新しいメッセージが書き込まれるたびに進めて待機者を起こす
+class RoomNotifier:
+    def __init__(self):
+        self._versions: Dict[int, int] = {}
+        self._waiters: Dict[
+            int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def version(self, room_id: int) -> int:
+        with self._lock:
+            return self._versions.get(room_id, 0)
+
+    # versionから版が進むか、timeout秒経つまで待つ。版が進んだらTrueを返す
+    async def wait(self, room_id: int, version: int, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._lock:
+            if self._versions.get(room_id, 0) != version:
+                return True
+            self._waiters.setdefault(room_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(room_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[room_id]
+
+    # 待機者は自分のループで起こす(MessageHub.publishと同じく、呼び出し元のループと違うことがある)
+    def notify(self, room_id: int):
+        with self._lock:
+            self._versions[room_id] = self._versions.get(room_id, 0) + 1
+            waiters = self._waiters.pop(room_id, set())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._wake, future)
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
+
+
+message_notifier = RoomNotifier()
+
+
+# 部屋の状態遷移(state / next_state_update_at の変化)をSSEの購読者に配る
+class RoomEventBroker:
+    def __init__(self, max_queue: int = 64):
+        self._max_queue = max_queue
+        self._rooms: Dict[int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = (
+            {}
+        )
+        self._lock = threading.Lock()
+
+    def subscribe(
+        self, room_id: int
+    ) -> Tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        subscriber = (
+            asyncio.get_running_loop(),
+            asyncio.Queue(maxsize=self._max_queue),
+        )
+        with self._lock:
+            self._rooms.setdefault(room_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(
+        self, room_id: int, subscriber: Tuple[asyncio.AbstractEventLoop, asyncio.Queue]
+    ):
+        with self._lock:
+            subscribers = self._rooms.get(room_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._rooms[room_id]
+
+    def subscribers(self, room_id: int) -> int:
+        with self._lock:
+            return len(self._rooms.get(room_id, ()))
+
+    # 購読者のキューには購読者のループで積む(MessageHub.publishと同じく、呼び出し元のループと違うことがある)
+    def publish(self, room_id: int, state: str, payload: str):
+        with self._lock:
+            subscribers = list(self._rooms.get(room_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._put, queue, (state, payload))
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, event: Tuple[str, str]):
+        # 状態は最新のものだけ分かればよいので、溢れたら古いイベントを捨てる
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+
+room_event_broker = RoomEventBroker()
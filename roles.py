@@ -0,0 +1,103 @@
+import random
+from models import (
+    ActionFlag,
+    RoleClassList,
+    RoleGroupDead,
+    RoleGroupVillager,
+    RoleGroupWolf,
+    RoomStateEnum,
+    ROOMINGAMESTATES,
+    UserStateEnum,
+)
+from typing import Dict, List, Tuple
+
+# 人狼はおよそ4人に1人。残りは村人にする
+WOLFRATIO = 4
+
+
+# 参加人数からRoleClassListのキーの配役を決める。
+# 人狼の次に、min_playersを満たす役職を登録順に1人ずつ入れ、残りを村人にする
+def role_distribution(player_count: int) -> List[str]:
+    if player_count <= 0:
+        return []
+    wolves = max(1, player_count // WOLFRATIO)
+    roles = ["wolf"] * wolves
+    for key, role in RoleClassList.items():
+        if len(roles) >= player_count:
+            break
+        if role.min_players is not None and role.min_players <= player_count:
+            roles.append(key)
+    roles += ["villager"] * (player_count - len(roles))
+    assert all(role in RoleClassList for role in roles)
+    return roles
+
+
+# user_id → role_key。seedを渡すと同じ配役を再現できる
+def assign_roles(user_ids: List[int], seed: int | None = None) -> Dict[int, str]:
+    roles = role_distribution(len(user_ids))
+    random.Random(seed).shuffle(roles)
+    return dict(zip(user_ids, roles))
+
+
+# (role_key, 部屋のstate) → 使えるアクション / 閲覧できるtarget_group。
+# 起動時にRoleClassListから一度だけ組み立て、リクエストごとの認可は辞書を1回引くだけにする
+def compile_permissions() -> (
+    Tuple[Dict[Tuple[str, str], ActionFlag], Dict[Tuple[str, str], Tuple[str, ...]]]
+):
+    actions = {}
+    groups = {}
+    for key, role in RoleClassList.items():
+        for state in RoomStateEnum:
+            actions[(key, state.value)] = role.actions.get(state.value, ActionFlag.NONE)
+            groups[(key, state.value)] = tuple(group.name for group in role.groups)
+    return actions, groups
+
+
+ROLEACTIONS, ROLEGROUPS = compile_permissions()
+
+
+def can(role_key: str | None, state: str, action: ActionFlag) -> bool:
+    return bool(ROLEACTIONS.get((role_key, state), ActionFlag.NONE) & action)
+
+
+ALLGROUPS = (RoleGroupVillager.name, RoleGroupWolf.name, RoleGroupDead.name)
+PUBLICGROUPS = (RoleGroupVillager.name,)
+
+
+# (role_key, 部屋のstate, ユーザーのstate) → 閲覧できるtarget_group。
+# ゲームの外では全員がすべての会話を読める(開始前は全体の会話しか無く、終了後は答え合わせになる)。
+# ゲーム中は死亡者と観戦者がすべてを、生存者は役職のグループだけを読める
+def compile_visibility() -> Dict[Tuple[str | None, str, str], Tuple[str, ...]]:
+    visibility = {}
+    for key in [None, *RoleClassList]:
+        for room_state in RoomStateEnum:
+            for user_state in UserStateEnum:
+                if room_state.value not in ROOMINGAMESTATES:
+                    groups = ALLGROUPS
+                elif user_state in (UserStateEnum.DEAD, UserStateEnum.WATCHER):
+                    groups = ALLGROUPS
+                elif user_state == UserStateEnum.ALIVE and key is not None:
+                    groups = ROLEGROUPS[(key, room_state.value)]
+                else:
+                    groups = PUBLICGROUPS
+                visibility[(key, room_state.value, user_state.value)] = groups
+    return visibility
+
+
+MESSAGEVISIBILITY = compile_visibility()
+
+
+def visible_groups(
+    role_key: str | None, room_state: str, user_state: str
+) -> Tuple[str, ...]:
+    return MESSAGEVISIBILITY.get((role_key, room_state, user_state), PUBLICGROUPS)
+
+
+# POST /messages/ の発言先。ゲーム中の死亡者と観戦者の発言は生存者に見せない
+def message_group(room_state: str, user_state: str) -> str:
+    if room_state in ROOMINGAMESTATES and user_state in (
+        UserStateEnum.DEAD.value,
+        UserStateEnum.WATCHER.value,
+    ):
+        return RoleGroupDead.name
+    return RoleGroupVillager.name
@@ -0,0 +1,155 @@
+import threading
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import ROOMINGAMESTATES, Room, User, UserStateEnum
+from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+# 1つの部屋のゲームの状態。ルールの判定はこれだけで済ませ、DBを読まない
+class RoomState:
+    __slots__ = ("state", "deadline", "members", "watchers", "roles", "alive")
+
+    def __init__(self, state: str, deadline: datetime):
+        self.state = state
+        self.deadline = deadline
+        self.members: Set[int] = set()
+        self.watchers: Set[int] = set()
+        self.roles: Dict[int, str] = {}
+        self.alive: Set[int] = set()
+
+    # 観戦者以外の参加者。game_startで役職を配る相手
+    def players(self) -> List[int]:
+        return sorted(self.members - self.watchers)
+
+    # 参加者のUser.state。ゲーム中に役職があって生きていなければ死亡者
+    def user_state(self, user_id: int) -> str:
+        if user_id not in self.members:
+            return str(UserStateEnum.OUTSIDE.value)
+        if user_id in self.watchers:
+            return str(UserStateEnum.WATCHER.value)
+        if user_id in self.alive:
+            return str(UserStateEnum.ALIVE.value)
+        if user_id in self.roles and self.state in ROOMINGAMESTATES:
+            return str(UserStateEnum.DEAD.value)
+        return str(UserStateEnum.OUTOFPLAY.value)
+
+
+# 部屋ごとのRoomStateを持つ。書き込みはDBにコミットしてからここにも反映する(ライトスルー)。
+# 手元に無い部屋は最初に使うときにDBから読み込む。読み込み中にその部屋への書き込みがあったら、
+# 読んだ内容は古いかもしれないので置かずに捨てる
+class RoomStates:
+    def __init__(self):
+        self._rooms: Dict[int, RoomState] = {}
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    async def get(self, session: AsyncSession, room_id: int) -> RoomState | None:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            generation = self._generations.get(room_id, 0)
+        if room is not None:
+            return room
+        row = (
+            await session.exec(
+                select(Room.state, Room.next_state_update_at).where(Room.id == room_id)
+            )
+        ).first()
+        if row is None:
+            return None
+        room = RoomState(*row)
+        for user_id, role_key, state in await session.exec(
+            select(User.id, User.role_key, User.state).where(User.room_id == room_id)
+        ):
+            room.members.add(user_id)
+            if state == str(UserStateEnum.WATCHER.value):
+                room.watchers.add(user_id)
+            if role_key is not None:
+                room.roles[user_id] = role_key
+            if state == str(UserStateEnum.ALIVE.value):
+                room.alive.add(user_id)
+        with self._lock:
+            if self._generations.get(room_id, 0) == generation:
+                room = self._rooms.setdefault(room_id, room)
+        return room
+
+    # 手元にある部屋だけを返す。DBは読まない
+    def peek(self, room_id: int) -> RoomState | None:
+        with self._lock:
+            return self._rooms.get(room_id)
+
+    def _changed(self, room_id: int) -> RoomState | None:
+        room = self._rooms.get(room_id)
+        if room is None:
+            self._generations[room_id] = self._generations.get(room_id, 0) + 1
+        return room
+
+    def create(self, room_id: int, state: str, deadline: datetime):
+        with self._lock:
+            self._rooms[room_id] = RoomState(state, deadline)
+
+    def enter(self, room_id: int, user_id: int, watcher: bool):
+        with self._lock:
+            room = self._changed(room_id)
+            if room is not None:
+                room.members.add(user_id)
+                if watcher:
+                    room.watchers.add(user_id)
+
+    def exit(self, room_id: int, user_id: int):
+        with self._lock:
+            room = self._changed(room_id)
+            if room is not None:
+                room.members.discard(user_id)
+                room.watchers.discard(user_id)
+                room.roles.pop(user_id, None)
+                room.alive.discard(user_id)
+
+    def start_game(
+        self, room_id: int, state: str, deadline: datetime, roles: Dict[int, str]
+    ):
+        with self._lock:
+            room = self._changed(room_id)
+            if room is not None:
+                room.state = state
+                room.deadline = deadline
+                room.roles.update(roles)
+                room.alive = set(roles)
+
+    # 状態遷移した部屋(room_id, state, deadline)をまとめて反映する
+    def advance(self, advanced: Iterable[Tuple[int, str, datetime]]):
+        with self._lock:
+            for room_id, state, deadline in advanced:
+                room = self._changed(room_id)
+                if room is not None:
+                    room.state = state
+                    room.deadline = deadline
+
+    # deathsは(room_id, user_id, role_key)
+    def kill(self, deaths: Iterable[Tuple[int, int, str | None]]):
+        with self._lock:
+            for room_id, user_id, _ in deaths:
+                room = self._changed(room_id)
+                if room is not None:
+                    room.alive.discard(user_id)
+
+    # ゲームの終わった部屋には生存者がいない(観戦者以外はOUTOFPLAYに戻る)
+    def end_games(self, room_ids: Iterable[int]):
+        with self._lock:
+            for room_id in room_ids:
+                room = self._changed(room_id)
+                if room is not None:
+                    room.alive.clear()
+
+    def discard(self, room_id: int):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._changed(room_id)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._generations.clear()
+
+
+room_states = RoomStates()
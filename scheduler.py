@@ -0,0 +1,149 @@
+from sqlalchemy import case, literal, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import Room, RoomStateEnum, ROOMSTATECYCLE, ROOMSTATETIME
+from voting import apply_votes, finish_votes
+from victory import alive_counter, end_games, finish_games
+from message_log import message_log
+from room_state import room_states
+from event_bus import publish_alive
+from datetime import datetime, timedelta
+from typing import Dict, List, Set, Tuple
+
+
+# ROOMSTATECYCLEの中で閉路になっている状態(DAYTIME→SUNSET→NIGHT→MORNING→DAYTIME)について、1周にかかる時間を求めておく
+def _cycle_periods() -> Dict[str, timedelta]:
+    periods = {}
+    for start in ROOMSTATECYCLE:
+        state = ROOMSTATECYCLE[start]
+        period = timedelta()
+        for _ in range(len(ROOMSTATECYCLE)):
+            if state is None:
+                break
+            period += timedelta(minutes=ROOMSTATETIME[state])
+            if state == start:
+                periods[start] = period
+                break
+            state = ROOMSTATECYCLE[state]
+    return periods
+
+
+CYCLEPERIOD = _cycle_periods()
+
+
+# 期限切れの部屋がnowの時点でどの状態にいるべきかを一度に求める。
+# 何周も取り残された部屋は周期分をまとめて飛ばすので、経過時間によらず状態数程度の手数で済む。
+def compute_transition(
+    state: str, next_state_update_at: datetime, now: datetime
+) -> Tuple[str, datetime]:
+    while next_state_update_at <= now and ROOMSTATECYCLE[state] is not None:
+        period = CYCLEPERIOD.get(state)
+        if period:
+            next_state_update_at += period * ((now - next_state_update_at) // period)
+        state = ROOMSTATECYCLE[state]
+        next_state_update_at += timedelta(minutes=ROOMSTATETIME[state])
+    return state, next_state_update_at
+
+
+# 期限切れの部屋だけをix_room_due(next_state_update_at, state)の範囲検索で取り出す。
+# CLOSEDの部屋は部分インデックスに含まれないので、部屋の総数が増えても走査量は変わらない。
+# PostgreSQLではFOR UPDATE SKIP LOCKEDで、他のワーカーが処理中の部屋を待たずに飛ばす。
+# 複数のワーカーが同時に起きても期限切れの部屋を分け合うことになる(SQLiteでは何も付かない)
+def select_due_rooms(now: datetime):
+    return (
+        select(Room.id, Room.state, Room.next_state_update_at)
+        .where(
+            Room.next_state_update_at <= now,
+            Room.state != str(RoomStateEnum.CLOSED.value),
+        )
+        .with_for_update(skip_locked=True)
+    )
+
+
+# room_idごとの値をCASE式にする。値は列の型で束縛する(freezegunのFakeDatetimeも日時として渡るように)
+def _by_room(column, values: Dict[int, object]):
+    return case(
+        {room_id: literal(value, column.type) for room_id, value in values.items()},
+        value=Room.id,
+    )
+
+
+# 読んだときの(state, next_state_update_at)のままの部屋だけを1文で書き換え、書き換えた部屋のidを返す。
+# 行ロックの効かないSQLiteや、読んだ後にgame_skipされた部屋でも、先に書いた方だけが進めるので二重に遷移しない
+async def claim_rooms(
+    session: AsyncSession,
+    ended: List[Tuple[int, str, datetime]],
+    advanced: List[Tuple[int, str, datetime]],
+) -> Set[int]:
+    claimed = await session.exec(
+        update(Room)
+        .where(
+            Room.id.in_([room_id for room_id, _, _ in ended]),
+            Room.state
+            == _by_room(Room.state, {room_id: state for room_id, state, _ in ended}),
+            Room.next_state_update_at
+            == _by_room(
+                Room.next_state_update_at,
+                {room_id: deadline for room_id, _, deadline in ended},
+            ),
+        )
+        .values(
+            state=_by_room(
+                Room.state, {room_id: state for room_id, state, _ in advanced}
+            ),
+            next_state_update_at=_by_room(
+                Room.next_state_update_at,
+                {room_id: deadline for room_id, _, deadline in advanced},
+            ),
+        )
+        .returning(Room.id)
+        .execution_options(synchronize_session=False)
+    )
+    return set(claimed.scalars().all())
+
+
+# 期限切れの部屋をすべて遷移させ、claim_roomsの一括UPDATE1文で書き込む。
+# SUNSET・NIGHTが終わった部屋の処刑・襲撃もメモリ上の得票数から決め、勝敗の決まった部屋の終了まで同じトランザクションでまとめて反映する
+async def advance_due_rooms(
+    session: AsyncSession, now: datetime | None = None
+) -> List[Tuple[int, str, datetime]]:
+    if now is None:
+        now = datetime.now()
+    advanced = []
+    ended = []
+    for room_id, state, next_state_update_at in await session.exec(
+        select_due_rooms(now)
+    ):
+        ended.append((room_id, state, next_state_update_at))
+        state, next_state_update_at = compute_transition(
+            state, next_state_update_at, now
+        )
+        advanced.append((room_id, state, next_state_update_at))
+    if advanced:
+        # 他のワーカーが先に進めた部屋は、処刑・襲撃も含めてここでは扱わない
+        claimed = await claim_rooms(session, ended, advanced)
+        ended = [entry for entry in ended if entry[0] in claimed]
+        advanced = [entry for entry in advanced if entry[0] in claimed]
+    if advanced:
+        deaths = await apply_votes(session, ended)
+        # 死亡で勝敗が決まった部屋は、そのままAFTERGAMEに移す
+        winners = alive_counter.winners(deaths)
+        if winners:
+            deadline = await end_games(session, winners, now)
+            aftergame = str(RoomStateEnum.AFTERGAME.value)
+            advanced = [
+                (entry[0], aftergame, deadline) if entry[0] in winners else entry
+                for entry in advanced
+            ]
+        await session.commit()
+        room_states.advance(advanced)
+        finish_votes(ended, deaths)
+        finish_games(winners)
+        publish_alive({room_id for room_id, _, _ in deaths} | set(winners))
+        for room_id, state, _ in advanced:
+            if state == str(RoomStateEnum.CLOSED.value):
+                message_log.discard(room_id)
+                room_states.discard(room_id)
+            else:
+                message_log.invalidate_room(room_id)
+    return advanced
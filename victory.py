@@ -0,0 +1,158 @@
+import threading
+from collections import Counter
+from sqlalchemy import func, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from cache import user_cache
+from room_state import room_states
+from models import (
+    Room,
+    RoomStateEnum,
+    ROOMSTATETIME,
+    User,
+    UserStateEnum,
+    ROLETOGROUP,
+)
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+
+# 役職グループごとの生存者数から勝敗を決める。
+# villagersには人狼も含まれるので、人狼以外の生存者数は villagers - wolves になる
+def judge(counts: Counter) -> str | None:
+    wolves = counts["wolves"]
+    if wolves <= 0:
+        return "villagers"
+    if wolves * 2 >= counts["villagers"]:
+        return "wolves"
+    return None
+
+
+# 部屋ごとに、ROLETOGROUPのグループ単位で生存者数を持つ。
+# 死亡のたびに差分だけ減らすので、勝敗の判定で参加者を数え直さなくてよい
+class AliveCounter:
+    def __init__(self):
+        self._rooms: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+
+    def start(self, room_id: int, role_keys: Iterable[str]):
+        counts = Counter()
+        for role_key in role_keys:
+            counts.update(ROLETOGROUP.get(role_key, []))
+        with self._lock:
+            self._rooms[room_id] = counts
+
+    def counts(self, room_id: int) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._rooms.get(room_id, {}))
+
+    # 再起動後など、手元に無い部屋の生存者数を1回のクエリで読み込む。
+    # 他のワーカーで変わった部屋はイベントバスでputされるので、手元にある部屋は読み直さない
+    async def load(self, session: AsyncSession, room_ids: Iterable[int]):
+        with self._lock:
+            missing = [room_id for room_id in room_ids if room_id not in self._rooms]
+        if not missing:
+            return
+        rooms = {room_id: Counter() for room_id in missing}
+        for room_id, role_key, count in await session.exec(
+            select(User.room_id, User.role_key, func.count(User.id))
+            .where(
+                User.room_id.in_(missing),
+                User.state == str(UserStateEnum.ALIVE.value),
+            )
+            .group_by(User.room_id, User.role_key)
+        ):
+            for group in ROLETOGROUP.get(role_key, []):
+                rooms[room_id][group] += count
+        with self._lock:
+            for room_id, counts in rooms.items():
+                self._rooms.setdefault(room_id, counts)
+
+    # 他のワーカーから届いた生存者数で置き換える。Noneならゲームが終わったので捨てる
+    def put(self, room_id: int, counts: Dict[str, int] | None):
+        with self._lock:
+            if counts is None:
+                self._rooms.pop(room_id, None)
+            else:
+                self._rooms[room_id] = Counter(counts)
+
+    # イベントバスで送る生存者数。手元に無ければNone
+    def snapshot(self, room_id: int) -> Dict[str, int] | None:
+        with self._lock:
+            counts = self._rooms.get(room_id)
+            return None if counts is None else dict(counts)
+
+    # deaths(room_id, user_id, role_key)を反映したときに勝敗が決まる部屋を返す。手元の生存者数は変えない
+    def winners(self, deaths: List[Tuple[int, int, str | None]]) -> Dict[int, str]:
+        with self._lock:
+            rooms = {
+                room_id: Counter(self._rooms[room_id])
+                for room_id, _, _ in deaths
+                if room_id in self._rooms
+            }
+        for room_id, _, role_key in deaths:
+            if room_id in rooms:
+                rooms[room_id].subtract(ROLETOGROUP.get(role_key, []))
+        winners = {}
+        for room_id, counts in rooms.items():
+            winner = judge(counts)
+            if winner is not None:
+                winners[room_id] = winner
+        return winners
+
+    # コミット後に呼ぶ
+    def record(self, deaths: List[Tuple[int, int, str | None]]):
+        with self._lock:
+            for room_id, _, role_key in deaths:
+                counts = self._rooms.get(room_id)
+                if counts is not None:
+                    counts.subtract(ROLETOGROUP.get(role_key, []))
+
+    def discard(self, room_id: int):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+
+alive_counter = AliveCounter()
+
+
+# 部屋をまとめてAFTERGAMEにし、観戦者以外をOUTOFPLAYに戻す。winnersの値は勝ったグループ(手動で終えたときはNone)。
+# コミットは呼び出し側で行い、その後にfinish_gamesを呼ぶ
+async def end_games(
+    session: AsyncSession, winners: Dict[int, str | None], now: datetime
+) -> datetime:
+    state = str(RoomStateEnum.AFTERGAME.value)
+    deadline = now + timedelta(minutes=ROOMSTATETIME[state])
+    await session.exec(
+        update(Room),
+        params=[
+            {
+                "id": room_id,
+                "state": state,
+                "next_state_update_at": deadline,
+                "winner": winner,
+            }
+            for room_id, winner in winners.items()
+        ],
+    )
+    await session.exec(
+        update(User)
+        .where(
+            User.room_id.in_(list(winners)),
+            User.state != str(UserStateEnum.WATCHER.value),
+        )
+        .values(state=str(UserStateEnum.OUTOFPLAY.value))
+        .execution_options(synchronize_session=False)
+    )
+    return deadline
+
+
+def finish_games(room_ids: Iterable[int]):
+    room_states.end_games(room_ids)
+    for room_id in room_ids:
+        alive_counter.discard(room_id)
+        user_cache.invalidate_room(room_id)
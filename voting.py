@@ -0,0 +1,195 @@
+import random
+import threading
+from collections import Counter
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from cache import user_cache
+from victory import alive_counter
+from room_state import room_states
+from models import (
+    ActionFlag,
+    Room,
+    RoomStateEnum,
+    ROOMSTATETIME,
+    User,
+    UserStateEnum,
+    Vote,
+    VoteKindEnum,
+)
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+# その状態の間に受け付ける票の種類。状態が終わるときにこの種類の票で処刑・襲撃を決める
+PHASEVOTEKIND = {
+    RoomStateEnum.SUNSET.value: VoteKindEnum.VOTE.value,
+    RoomStateEnum.NIGHT.value: VoteKindEnum.ATTACK.value,
+}
+
+# 票の種類ごとに必要なアクションの権限
+VOTEKINDACTION = {
+    VoteKindEnum.VOTE.value: ActionFlag.VOTE,
+    VoteKindEnum.ATTACK.value: ActionFlag.ATTACK,
+}
+
+
+# 1つの部屋の、いま受け付けている票。deadlineはその状態の終了時刻で、前の状態の票と区別するのに使う。
+# targetsは投票者ごとの(Vote.id, 投票先)で、idの大きい票だけを有効にする
+class RoomBallot:
+    __slots__ = ("kind", "deadline", "targets", "counts")
+
+    def __init__(self, kind: str, deadline: datetime):
+        self.kind = kind
+        self.deadline = deadline
+        self.targets: Dict[int, Tuple[int, int]] = {}
+        self.counts: Counter = Counter()
+
+
+# 部屋ごとの得票数をメモリ上で持ち、1票ごとに差分だけ更新する。
+# 状態の終了時は票の行を集計し直さず、この得票数から最多票の参加者を選ぶ。
+# 他のワーカーで受けた票はイベントバスで届くので、同じcastで反映する。
+# 届く順番は前後するので、投票者ごとにVote.idの大きい票だけを有効にし、同じ票が2回届いても数えない
+class VoteTally:
+    def __init__(self):
+        self._rooms: Dict[int, RoomBallot] = {}
+        self._lock = threading.Lock()
+
+    def cast(
+        self,
+        room_id: int,
+        kind: str,
+        deadline: datetime,
+        user_id: int,
+        target_id: int,
+        vote_id: int,
+    ):
+        with self._lock:
+            ballot = self._rooms.get(room_id)
+            if ballot is None or (ballot.kind, ballot.deadline) != (kind, deadline):
+                # 集計の終わった前の状態の票が遅れて届いた
+                if ballot is not None and deadline < ballot.deadline:
+                    return
+                ballot = self._rooms[room_id] = RoomBallot(kind, deadline)
+            previous = ballot.targets.get(user_id)
+            if previous is not None:
+                if previous[0] >= vote_id:
+                    return
+                ballot.counts[previous[1]] -= 1
+                if not ballot.counts[previous[1]]:
+                    del ballot.counts[previous[1]]
+            ballot.targets[user_id] = (vote_id, target_id)
+            ballot.counts[target_id] += 1
+
+    def counts(self, room_id: int, kind: str, deadline: datetime) -> Dict[int, int]:
+        with self._lock:
+            ballot = self._rooms.get(room_id)
+            if ballot is None or (ballot.kind, ballot.deadline) != (kind, deadline):
+                return {}
+            return dict(ballot.counts)
+
+    # 最多票の参加者を返す。同数なら無作為に1人選ぶ
+    def leader(self, room_id: int, kind: str, deadline: datetime) -> int | None:
+        counts = self.counts(room_id, kind, deadline)
+        if not counts:
+            return None
+        top = max(counts.values())
+        return random.choice(sorted(t for t, count in counts.items() if count == top))
+
+    # 集計を終えた状態の票を捨てる。deadlineを渡すと、その間に入った次の状態の票は残す
+    def discard(self, room_id: int, deadline: datetime | None = None):
+        with self._lock:
+            ballot = self._rooms.get(room_id)
+            if ballot is not None and deadline in (None, ballot.deadline):
+                del self._rooms[room_id]
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+    # 起動時に、SUNSET・NIGHTの部屋について今の状態になってから期限までの票を読み込む。
+    # 読んでいる間にイベントバスで届いた票とはVote.idで重複を除くので、手元の集計は捨てない
+    async def load(self, session: AsyncSession):
+        rooms = {
+            room_id: (state, deadline)
+            for room_id, state, deadline in await session.exec(
+                select(Room.id, Room.state, Room.next_state_update_at).where(
+                    Room.state.in_(list(PHASEVOTEKIND))
+                )
+            )
+        }
+        if not rooms:
+            return
+        started_at = {
+            room_id: deadline - timedelta(minutes=ROOMSTATETIME[state])
+            for room_id, (state, deadline) in rooms.items()
+        }
+        votes = await session.exec(
+            select(Vote)
+            .where(
+                Vote.room_id.in_(list(rooms)),
+                Vote.created_at >= min(started_at.values()),
+                Vote.created_at < max(deadline for _, deadline in rooms.values()),
+            )
+            .order_by(Vote.id)
+        )
+        for vote in votes:
+            state, deadline = rooms[vote.room_id]
+            if (
+                vote.kind == PHASEVOTEKIND[state]
+                and started_at[vote.room_id] <= vote.created_at < deadline
+            ):
+                self.cast(
+                    vote.room_id,
+                    vote.kind,
+                    deadline,
+                    vote.user_id,
+                    vote.target_id,
+                    vote.id,
+                )
+
+
+vote_tally = VoteTally()
+
+
+# 状態が終わる部屋(room_id, 終わる状態, その状態の期限)の処刑・襲撃をまとめて決め、
+# 対象者を1文でDEADにして、死亡した参加者の(room_id, user_id, role_key)を返す。
+# コミットは呼び出し側で行い、その後にfinish_votesを呼ぶ
+async def apply_votes(
+    session: AsyncSession, ended: List[Tuple[int, str, datetime]]
+) -> List[Tuple[int, int, str | None]]:
+    victims = {}
+    for room_id, state, deadline in ended:
+        kind = PHASEVOTEKIND.get(state)
+        if kind is None:
+            continue
+        victim = vote_tally.leader(room_id, kind, deadline)
+        if victim is not None:
+            victims[room_id] = victim
+    if not victims:
+        return []
+    # 勝敗判定用の生存者数は死亡を反映する前の値で読み込んでおく
+    await alive_counter.load(session, victims)
+    deaths = await session.exec(
+        update(User)
+        .where(
+            User.id.in_(list(victims.values())),
+            User.state == str(UserStateEnum.ALIVE.value),
+        )
+        .values(state=str(UserStateEnum.DEAD.value))
+        .returning(User.room_id, User.id, User.role_key)
+        .execution_options(synchronize_session=False)
+    )
+    return [(room_id, user_id, role_key) for room_id, user_id, role_key in deaths]
+
+
+def finish_votes(
+    ended: List[Tuple[int, str, datetime]],
+    deaths: List[Tuple[int, int, str | None]],
+):
+    for room_id, state, deadline in ended:
+        if state in PHASEVOTEKIND:
+            vote_tally.discard(room_id, deadline)
+    alive_counter.record(deaths)
+    room_states.kill(deaths)
+    for room_id in {room_id for room_id, _, _ in deaths}:
+        user_cache.invalidate_room(room_id)